@@ -0,0 +1,144 @@
+#Admission control for training requests: every HTTP worker runs at most TRAINING_SLOTS trainings at once and keeps at
+#most TRAINING_QUEUE more waiting for a slot. A request's cost is estimated in rounds simulated before it runs, and
+#when the work already running and queued means it wouldn't finish within TARGET_SECONDS it's trained on a cheaper
+#profile (fewer restarts, then a 21-bit genome) instead; when even the cheapest wouldn't, or the queue is full, or a
+#slot doesn't come up in time, it's turned away straight away with a Retry-After hint rather than left to time out
+#slots and the queue are shared by the threads of one worker process, so the policy needs a threaded server
+#(gunicorn --worker-class gthread --threads TRAINING_SLOTS+TRAINING_QUEUE, as in the Dockerfile); a sync worker only
+#ever has one request in flight, so nothing would queue and only a request's own cost would change its profile
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+import metrics
+from players import poolFromCounts
+
+TRAINING_SLOTS = int(os.environ.get("TRAINING_SLOTS", "2")) #trainings running at once per worker
+TRAINING_QUEUE = int(os.environ.get("TRAINING_QUEUE", "8")) #requests waiting for a slot before new ones get a 429
+QUEUE_TIMEOUT = float(os.environ.get("QUEUE_TIMEOUT", "20")) #seconds a request waits for a slot before it gets a 503
+ROUNDS_PER_SECOND = float(os.environ.get("ROUNDS_PER_SECOND", "500000")) #one core's throughput, for the estimates
+TARGET_SECONDS = float(os.environ.get("TARGET_SECONDS", "10")) #how long a request may take, queueing included
+EXACT_NODES = int(os.environ.get("EXACT_NODES", "2000")) #search nodes an exact solve gets before it returns its best genome and bound
+
+NUM_ROUNDS = 20
+ANNEAL_STEPS = math.ceil(math.log(.1/100)/math.log(.99)) + 1 #cooling steps from temperature 100 at coolingMul .99, plus the start
+NODE_EVALUATIONS = 8 #an exact solver node costs about this many evaluations (it advances every stuck game and re-bounds it)
+
+#name: (restarts, memSize, evaluations cap), most expensive first; smaller genomes are embedded back into 149 bits
+PROFILES = {
+    "full": (5, 149, None),
+    "reduced": (2, 149, None),
+    "minimal": (1, 21, 300),
+}
+
+class Overloaded(Exception):
+    def __init__(self, status, message, retryAfter):
+        super().__init__(message)
+        self.status = status #429 when the queue is full, 503 when the work doesn't fit or a slot didn't come up in time
+        self.retryAfter = retryAfter #whole seconds
+
+def roundsPerEvaluation(players):
+    #one game per strategy that's in the pool (counts only weigh the games), plus half a game of self-play
+    opponents = sum(1 for _, count in poolFromCounts(players) if count > 0)
+    return opponents*NUM_ROUNDS + NUM_ROUNDS//2
+
+def estimateCost(players, profile="full", budget=None, mode="anneal"):
+    #rounds simulated by an annealing run on the profile, or by an exact solve, with a budget's limits taken into account
+    #how many nodes a solve needs depends on how soon its bound closes, so it's priced at its EXACT_NODES cap
+    if mode == "exact":
+        nodes = EXACT_NODES
+        if budget is not None and budget.get("maxEvaluations") is not None:
+            nodes = min(nodes, budget["maxEvaluations"])
+        evaluations = nodes*NODE_EVALUATIONS
+    else:
+        restarts, _, cap = PROFILES[profile]
+        evaluations = restarts*ANNEAL_STEPS
+        if cap is not None:
+            evaluations = min(evaluations, cap)
+        if budget is not None and budget.get("maxEvaluations") is not None:
+            evaluations = min(evaluations, budget["maxEvaluations"])
+    rounds = evaluations*roundsPerEvaluation(players)
+    if budget is not None and budget.get("seconds") is not None:
+        rounds = min(rounds, int(budget["seconds"]*ROUNDS_PER_SECOND))
+    return rounds
+
+class AdmissionControl:
+    def __init__(self, slots: int, queueSize: int, targetSeconds: float, timeout: float):
+        self.slots = slots
+        self.queueSize = queueSize
+        self.targetSeconds = targetSeconds
+        self.timeout = timeout
+        self.running = 0
+        self.waiting = 0
+        self.pendingRounds = 0 #estimated rounds of everything running or waiting
+        self.decisions = {}
+        self.condition = threading.Condition()
+
+    def retryAfter(self):
+        #roughly how long the work already admitted takes to clear
+        return max(1, math.ceil(self.pendingRounds/(ROUNDS_PER_SECOND*self.slots)))
+
+    def choose(self, costs):
+        #the most expensive profile that would still finish in time behind the work already admitted; costs is {profile: rounds}
+        for profile in PROFILES:
+            if profile in costs and (self.pendingRounds/self.slots + costs[profile])/ROUNDS_PER_SECOND <= self.targetSeconds:
+                return profile
+        return None
+
+    def decide(self, decision):
+        self.decisions[decision] = self.decisions.get(decision, 0) + 1
+        if metrics.enabled:
+            metrics.ADMISSION_DECISIONS.inc(labels=(decision,))
+
+    def gauges(self):
+        if metrics.enabled:
+            metrics.TRAINING_QUEUE.set(self.running, ("running",))
+            metrics.TRAINING_QUEUE.set(self.waiting, ("waiting",))
+
+    @contextmanager
+    def admit(self, costs):
+        #yields the profile to train on while holding a slot; raises Overloaded instead of queueing a hopeless request
+        with self.condition:
+            if self.running >= self.slots and self.waiting >= self.queueSize:
+                self.decide("rejected_queue_full")
+                raise Overloaded(429, "Too many training requests queued, try again later", self.retryAfter())
+            profile = self.choose(costs)
+            if profile is None:
+                self.decide("rejected_cost")
+                raise Overloaded(503, "The server is too busy for this request, try again later", self.retryAfter())
+            cost = costs[profile]
+            self.pendingRounds += cost
+            self.waiting += 1
+            self.gauges()
+            deadline = time.monotonic() + self.timeout
+            while self.running >= self.slots:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.waiting -= 1
+                    self.pendingRounds -= cost
+                    self.gauges()
+                    self.decide("rejected_timeout")
+                    raise Overloaded(503, "Timed out waiting for a training slot, try again later", self.retryAfter())
+                self.condition.wait(remaining)
+            self.waiting -= 1
+            self.running += 1
+            self.gauges()
+            self.decide(profile)
+        try:
+            yield profile
+        finally:
+            with self.condition:
+                self.running -= 1
+                self.pendingRounds -= cost
+                self.gauges()
+                self.condition.notify()
+
+    def stats(self):
+        with self.condition:
+            return {"running": self.running, "waiting": self.waiting, "pendingRounds": self.pendingRounds,
+                    "slots": self.slots, "queueSize": self.queueSize, "targetSeconds": self.targetSeconds,
+                    "timeout": self.timeout, "roundsPerSecond": ROUNDS_PER_SECOND, "exactNodes": EXACT_NODES,
+                    "profiles": {name: {"restarts": restarts, "memSize": memSize, "maxEvaluations": cap}
+                                 for name, (restarts, memSize, cap) in PROFILES.items()},
+                    "decisions": dict(self.decisions)}
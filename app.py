@@ -1,7 +1,20 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 import json 
+import random
+import threading
+import time
+from contextlib import nullcontext
+from functools import partial
+import metrics
 from game import * #mainly train_simulated_annealing and successor
 from players import * #all player types
+from solver import solveBestResponse
+from fitness_table import train_table_lookup
+from ecology import evolve, populationShares, DYNAMICS
+from results import ResultCache, requestKey, RESULT_CACHE_DB, RESULT_CACHE_SIZE
+from genomes import GenomeStore, GENOME_STORE_DB, GENOME_STORE_SIZE, configuration, distance
+from jobs import JobStore, JobRunner, QueueFull, JOBS_DB, TRAINING_WORKERS, MAX_QUEUED_JOBS, DONE
+from admission import AdmissionControl, Overloaded, PROFILES, EXACT_NODES, estimateCost, TRAINING_SLOTS, TRAINING_QUEUE, TARGET_SECONDS, QUEUE_TIMEOUT
 
 app = Flask(__name__)
 
@@ -11,34 +24,400 @@ app = Flask(__name__)
 def home():
     return "Hello, world!"
 
+def parse_budget(j):
+    #optional {"seconds": ..., "maxEvaluations": ...}; training stops at whichever runs out first
+    budget = j.get("budget")
+    if budget is None:
+        return None
+    if not isinstance(budget, dict):
+        raise ValueError("budget must be an object")
+    seconds = budget.get("seconds")
+    maxEvaluations = budget.get("maxEvaluations")
+    if seconds is not None and (not isinstance(seconds, (int, float)) or seconds <= 0):
+        raise ValueError("budget.seconds must be a positive number")
+    if maxEvaluations is not None and (not isinstance(maxEvaluations, int) or maxEvaluations <= 0):
+        raise ValueError("budget.maxEvaluations must be a positive integer")
+    return Budget(seconds=seconds, maxEvaluations=maxEvaluations)
+
+#the stores below are made on first use; request threads (gthread workers) can get there at the same time, and each
+#must end up with the one instance (two ResultCaches would each single-flight only their own requests)
+singletonLock = threading.Lock()
+
+genomeStore = None
+
+def get_genome_store():
+    global genomeStore
+    if genomeStore is None:
+        with singletonLock:
+            if genomeStore is None:
+                genomeStore = GenomeStore(GENOME_STORE_DB, GENOME_STORE_SIZE)
+    return genomeStore
+
+MODES = ("anneal", "exact", "table")
+
+def train_model(mode, players, payoffs, budget, warmStart=True, cache=fitnessCache, seed=None, profile="full"):
+    #one entry per strategy with its count, so the pool size doesn't change how many games get played
+    models = poolFromCounts(players)
+    if mode == "exact":
+        #capped so admission control's estimate holds; a solve cut short still returns its best genome and bound
+        budget = budget if budget is not None else Budget()
+        budget.maxEvaluations = min(budget.maxEvaluations or EXACT_NODES, EXACT_NODES)
+        model, perf, upperBound = solveBestResponse(payoffs, models, 149, budget=budget)
+    elif mode == "table":
+        model, perf = train_table_lookup(models, payoffs)
+        #the same strategy as a 149-bit genome, which is what the frontend plays
+        model = embedModel(model, 21, 149)
+    else:
+        #a busy server trains on a cheaper profile (see admission.py): fewer restarts, or a smaller genome embedded into 149 bits
+        numRestarts, memSize, maxEvaluations = PROFILES[profile]
+        if maxEvaluations is not None:
+            budget = budget if budget is not None else Budget()
+            budget.maxEvaluations = min(budget.maxEvaluations or maxEvaluations, maxEvaluations)
+        #the first restarts start from genomes trained for the most similar earlier requests
+        initialModels = get_genome_store().nearest(models, payoffs, 149) if warmStart and memSize == 149 else None
+        model, perf = train_simulated_annealing(numRestarts=numRestarts, temperature=100, successor=successor, models=models, payoffs=payoffs, memSize=memSize, cache=cache, seed=seed, budget=budget, initialModels=initialModels)
+        if memSize != 149:
+            model = embedModel(model, memSize, 149)
+    get_genome_store().add(models, payoffs, 149, model, perf)
+    # print(models)
+    print(bin(model))
+    # print(perf)
+    response = {"model": bin(model)[2:]}
+    if mode == "exact":
+        response.update({"fitness": perf, "upperBound": upperBound, "optimal": perf >= upperBound})
+    elif mode == "table":
+        response["fitness"] = perf
+    if profile != "full":
+        response["profile"] = profile
+    if budget is not None:
+        response["stats"] = budget.stats()
+    return response
+
+admission = AdmissionControl(TRAINING_SLOTS, TRAINING_QUEUE, TARGET_SECONDS, QUEUE_TIMEOUT)
+
+def admitted_training(mode, players, budget, train):
+    #train(profile=...) once admission control lets it run; table lookups are cheap enough to skip it, and the exact
+    #solver has no cheaper profile, so it either runs in full or gets turned away
+    if mode == "table":
+        return train()
+    profiles = PROFILES if mode == "anneal" else ["full"]
+    with admission.admit({profile: estimateCost(players, profile, budget, mode) for profile in profiles}) as profile:
+        return train(profile=profile)
+
+def overloaded_response(error):
+    return {"error": str(error), "retryAfter": error.retryAfter}, error.status, {"Retry-After": str(error.retryAfter)}
+
+def check_players(players):
+    if not isinstance(players, dict) or not all(isinstance(count, (int, float)) and count >= 0 for count in players.values()):
+        raise ValueError("players must map strategy names to non-negative counts")
+
+resultCache = None
+
+def get_result_cache():
+    global resultCache
+    if resultCache is None:
+        with singletonLock:
+            if resultCache is None:
+                resultCache = ResultCache(RESULT_CACHE_DB, RESULT_CACHE_SIZE)
+    return resultCache
+
 @app.route('/get_model', methods=["POST"])
 def get_players():
     j = request.get_json()
     players = j["players"]
     payoffs = j["payoffs"]
+    try:
+        check_players(players)
+        budget = parse_budget(j)
+    except ValueError as error:
+        return {"error": str(error)}, 400
     # print(players)
-    models = []
-    #Ugly code but it's ok
-    for i in range(players['Tit For Tat']):
-        models.append(TitForTat())
-    for i in range(players['Grim Trigger']):
-        models.append(GrimTrigger())
-    for i in range(players['Two Tit For Tat']):
-        models.append(TwoTitForTat())
-    for i in range(players['Nice Tit For Tat']):
-        models.append(NiceTitForTat())
-    for i in range(players['Always Cooperate']):
-        models.append(Cooperator())
-    for i in range(players['Always Defect']):
-        models.append(Defector())
-    for i in range(players['Suspicious Tit For Tat']):
-        models.append(SuspiciousTitForTat())
     
-    model, perf = train_simulated_annealing(numRestarts=5, temperature=100, successor=successor, models=models, payoffs=payoffs, memSize=149)
-    # print(models)
-    print(bin(model))
-    # print(perf)
-    return {"model": bin(model)[2:]}
+    #"mode": "exact" solves for the best genome against the pool instead of searching for a good one,
+    #and also returns the fitness and an upper bound (equal to it when the answer is proven optimal)
+    #"mode": "table" looks up the best 21-bit genome in the prebuilt fitness table (see fitness_table.py)
+    mode = j.get("mode", "anneal")
+    if mode not in MODES:
+        return {"error": "mode must be \"anneal\", \"exact\" or \"table\""}, 400
+    #"warmStart": false trains from random genomes only
+    train = partial(admitted_training, mode, players, j.get("budget"), partial(train_model, mode, players, payoffs, budget, j.get("warmStart", True)))
+    #"timings": true adds a breakdown of where this request spent its time (needs METRICS enabled for more than the total)
+    with metrics.timings() if j.get("timings") else nullcontext() as timings:
+        try:
+            #identical requests share one training run and its stored result, unless "cache": false
+            if j.get("cache", True):
+                response, outcome = get_result_cache().getOrCompute(requestKey(mode, players, payoffs, j.get("budget"), j.get("warmStart", True)), train)
+            else:
+                response, outcome = train(), "bypass"
+        except FileNotFoundError:
+            return {"error": "The fitness table hasn't been built (python fitness_table.py)"}, 503
+        except Overloaded as error:
+            return overloaded_response(error)
+    if timings is not None:
+        response = dict(response, timings=timings)
+    return response, 200, {"X-Cache": outcome}
+
+MAX_BATCH = 100 #configurations per /get_models request
+BATCH_GAMES = 50000 #game results a /get_models request keeps (about 250 bytes each); the oldest go first
+
+def trainingOrder(configs, useCache):
+    #cached results first, then each one after the configuration nearest the last, so every training run
+    #warm starts from (and shares games with) the one before it
+    cached = [key for key in configs if useCache and get_result_cache().get(key) is not None]
+    rest = [key for key in configs if key not in cached]
+    order = cached
+    points = {key: configuration(poolFromCounts(configs[key]["players"]), configs[key]["payoffs"])[:2] for key in rest}
+    while rest:
+        last = points.get(order[-1]) if order else None
+        nearest = rest[0] if last is None else min(rest, key=lambda key: distance(last, points[key]))
+        rest.remove(nearest)
+        order.append(nearest)
+    return order
+
+# Many /get_model requests in one: {"configurations": [{"players": ..., "payoffs": ...}, ...]}, where anything a
+# configuration leaves out (payoffs, mode, budget, warmStart) comes from the top level of the body
+# identical configurations are trained once, and every training run uses the same random seed and shares one cache of
+# game results, so neighbouring configurations mostly search the same genomes and play each game once; results stream
+# back as JSON lines as each configuration finishes: the /get_model response plus "indices" (the configurations it
+# answers) and "cache" (what X-Cache would say), or {"indices": [...], "error": ...}
+@app.route('/get_models', methods=["POST"])
+def get_models():
+    j = request.get_json()
+    configurations = j.get("configurations")
+    if not isinstance(configurations, list) or not 0 < len(configurations) <= MAX_BATCH:
+        return {"error": f"configurations must be a list of 1 to {MAX_BATCH} requests"}, 400
+    defaults = {name: j[name] for name in ("payoffs", "mode", "budget", "warmStart") if name in j}
+    configs = {}
+    for index, config in enumerate(configurations):
+        try:
+            check_players(config.get("players") if isinstance(config, dict) else None)
+        except ValueError as error:
+            return {"error": f"configuration {index}: {error}"}, 400
+        config = dict(defaults, **config)
+        if "payoffs" not in config:
+            return {"error": f"configuration {index} has no payoffs"}, 400
+        if config.get("mode", "anneal") not in MODES:
+            return {"error": "mode must be \"anneal\", \"exact\" or \"table\""}, 400
+        try:
+            parse_budget(config)
+        except ValueError as error:
+            return {"error": f"configuration {index}: {error}"}, 400
+        key = requestKey(config.get("mode", "anneal"), config["players"], config["payoffs"], config.get("budget"), config.get("warmStart", True))
+        configs.setdefault(key, dict(config, indices=[]))["indices"].append(index)
+    useCache = j.get("cache", True)
+    order = trainingOrder(configs, useCache)
+    games = GameCache(BATCH_GAMES)
+    #trainers seed their own random.Random with it, so other requests' randomness isn't touched
+    seed = random.getrandbits(32)
+
+    def stream():
+        for key in order:
+            config = configs[key]
+            #the budget's clock starts when its configuration's turn comes
+            mode = config.get("mode", "anneal")
+            train = partial(admitted_training, mode, config["players"], config.get("budget"),
+                            partial(train_model, mode, config["players"], config["payoffs"], parse_budget(config), config.get("warmStart", True), games, seed))
+            try:
+                if useCache:
+                    response, outcome = get_result_cache().getOrCompute(key, train)
+                else:
+                    response, outcome = train(), "bypass"
+            except FileNotFoundError:
+                yield json.dumps({"indices": config["indices"], "error": "The fitness table hasn't been built (python fitness_table.py)"}) + "\n"
+                continue
+            except Overloaded as error:
+                yield json.dumps({"indices": config["indices"], "error": str(error), "retryAfter": error.retryAfter}) + "\n"
+                continue
+            yield json.dumps(dict(response, indices=config["indices"], cache=outcome)) + "\n"
+    return Response(stream(), mimetype="application/x-ndjson")
+
+@app.route('/cache')
+def cache_stats():
+    return get_result_cache().stats()
+
+# The admission policy, how many trainings are running and queued in this worker, and what was decided so far
+@app.route('/admission')
+def admission_stats():
+    return admission.stats()
+
+MAX_GENERATIONS = 100000
+MAX_ENTRANTS = 256 #genomes per /ecology request; the tournament plays every pair of them
+
+def parse_genome(model):
+    #a bit string as /get_model returns it -> the player it encodes
+    if not isinstance(model, str) or not 0 < len(model) <= 149 or set(model) - {"0", "1"}:
+        raise ValueError("genomes must be bit strings of at most 149 bits")
+    return ModelPlayer149(int(model, 2))
+
+def parse_population(j):
+    #the strategies from "players" (counts as in /get_model) plus trained genomes from "genomes": each a bit string
+    #as /get_model returns it, or {"model": ..., "count": ...}; returns (players, names, counts)
+    genomes = j.get("genomes", [])
+    if not isinstance(genomes, list) or len(genomes) > MAX_ENTRANTS:
+        raise ValueError(f"genomes must be a list of at most {MAX_ENTRANTS} entries")
+    players, names, counts = [], [], []
+    for player, count in poolFromCounts(j.get("players", {})):
+        if count > 0:
+            players.append(player)
+            names.append(player.name)
+            counts.append(count)
+    for k, genome in enumerate(genomes):
+        model, count = (genome, 1) if isinstance(genome, str) else (genome.get("model"), genome.get("count", 1))
+        if not isinstance(count, (int, float)) or count <= 0:
+            raise ValueError("genome counts must be positive numbers")
+        players.append(parse_genome(model))
+        names.append(f"Genome {k}")
+        counts.append(count)
+    populationShares(counts)
+    return players, names, counts
+
+# Streams how the population's shares change over the generations, one JSON object per line:
+# first {"types": [...]} in the order the shares use, then {"generation": g, "shares": [...]} every "every" generations
+@app.route('/ecology', methods=["POST"])
+def ecology():
+    j = request.get_json()
+    payoffs = j["payoffs"]
+    generations = j.get("generations", 1000)
+    every = j.get("every", 1)
+    dynamics = j.get("dynamics", "discrete")
+    step = j.get("step", .1)
+    if not isinstance(generations, int) or not 0 <= generations <= MAX_GENERATIONS:
+        return {"error": f"generations must be an integer from 0 to {MAX_GENERATIONS}"}, 400
+    if not isinstance(every, int) or every <= 0:
+        return {"error": "every must be a positive integer"}, 400
+    if dynamics not in DYNAMICS:
+        return {"error": f"dynamics must be one of {', '.join(DYNAMICS)}"}, 400
+    if not isinstance(step, (int, float)) or step <= 0:
+        return {"error": "step must be a positive number"}, 400
+    try:
+        players, names, counts = parse_population(j)
+    except ValueError as error:
+        return {"error": str(error)}, 400
+    #played before streaming starts, so a bad payoff matrix still gets an error status
+    matrix = tournamentMatrix(payoffs, players)
+
+    def stream():
+        yield json.dumps({"types": names}) + "\n"
+        for generation, shares in enumerate(evolve(matrix, counts, generations, dynamics, step)):
+            if generation % every == 0 or generation == generations:
+                yield json.dumps({"generation": generation, "shares": shares.tolist()}) + "\n"
+    return Response(stream(), mimetype="application/x-ndjson")
+
+MAX_REPLAY_ROUNDS = 10**9
+
+def format_event(event, sse):
+    if sse:
+        return f"data: {json.dumps(event)}\n\n"
+    return json.dumps(event) + "\n"
+
+def parse_opponent(opponent):
+    #a strategy's name as /get_model counts it, or a genome bit string
+    for strategy in baseStrategies:
+        if strategy().name == opponent:
+            return strategy()
+    return parse_genome(opponent)
+
+# Streams a trained genome's games round by round: {"genome": "...", "payoffs": ..., "opponents": [...], "rounds": n}
+# opponents are strategy names or genome bit strings, all of baseStrategies (a whole tournament) if left out
+# each game is {"match": k, "players": [...]}, then replayGame's rounds, cycle marker and scores, one JSON object per
+# line, or as server-sent events with "format": "sse"; games are played as they're sent, so a long replay with a
+# cycle costs no more than its rounds up to the cycle
+@app.route('/replay', methods=["POST"])
+def replay():
+    j = request.get_json()
+    payoffs = j["payoffs"]
+    numRounds = j.get("rounds", 100)
+    sse = j.get("format", "ndjson") == "sse"
+    if not isinstance(numRounds, int) or not 0 < numRounds <= MAX_REPLAY_ROUNDS:
+        return {"error": f"rounds must be an integer from 1 to {MAX_REPLAY_ROUNDS}"}, 400
+    if not (isinstance(payoffs, list) and len(payoffs) == 2 and all(isinstance(row, list) and len(row) == 2 and
+            all(isinstance(p, (int, float)) for p in row) for row in payoffs)):
+        return {"error": "payoffs must be a 2x2 matrix of numbers"}, 400
+    if j.get("format", "ndjson") not in ("ndjson", "sse"):
+        return {"error": "format must be \"ndjson\" or \"sse\""}, 400
+    try:
+        player = parse_genome(j.get("genome"))
+        opponents = [parse_opponent(opponent) for opponent in j.get("opponents", [strategy().name for strategy in baseStrategies])]
+    except ValueError:
+        return {"error": "genome must be a bit string and opponents strategy names or bit strings"}, 400
+
+    def stream():
+        for k, opponent in enumerate(opponents):
+            yield format_event({"match": k, "players": [player.name, opponent.name]}, sse)
+            for event in replayGame(payoffs, player, opponent, numRounds):
+                yield format_event(event, sse)
+    return Response(stream(), mimetype="text/event-stream" if sse else "application/x-ndjson")
+
+jobRunner = None
+
+def get_job_runner():
+    global jobRunner
+    if jobRunner is None:
+        with singletonLock:
+            if jobRunner is None:
+                jobRunner = JobRunner(JobStore(JOBS_DB), TRAINING_WORKERS, MAX_QUEUED_JOBS)
+    return jobRunner
+
+# Same body as /get_model, but returns a job id straight away and trains in the background
+@app.route('/jobs', methods=["POST"])
+def submit_job():
+    j = request.get_json()
+    params = {"players": j["players"], "payoffs": j["payoffs"], "warmStart": j.get("warmStart", True)}
+    if j.get("budget") is not None:
+        #checked here, but the clock only starts once a worker picks the job up
+        try:
+            parse_budget(j)
+        except ValueError as error:
+            return {"error": str(error)}, 400
+        params["budget"] = j["budget"]
+    try:
+        jobId = get_job_runner().submit(params)
+    except QueueFull:
+        return {"error": "Too many training jobs queued, try again later"}, 503, {"Retry-After": "5"}
+    return {"jobId": jobId}, 202
+
+@app.route('/jobs/<jobId>')
+def job_status(jobId):
+    runner = get_job_runner()
+    runner.reap()
+    job = runner.store.get(jobId)
+    if job is None:
+        return {"error": "No such job"}, 404
+    return {"jobId": jobId, "status": job["status"], "progress": job["progress"], "error": job["error"]}
+
+@app.route('/jobs/<jobId>/result')
+def job_result(jobId):
+    runner = get_job_runner()
+    runner.reap()
+    job = runner.store.get(jobId)
+    if job is None:
+        return {"error": "No such job"}, 404
+    if job["status"] != DONE:
+        return {"jobId": jobId, "status": job["status"]}, 409
+    return job["result"]
+
+@app.route('/jobs/<jobId>', methods=["DELETE"])
+def cancel_job(jobId):
+    runner = get_job_runner()
+    if runner.store.get(jobId) is None:
+        return {"error": "No such job"}, 404
+    runner.store.requestCancel(jobId)
+    return {"jobId": jobId, "status": runner.store.get(jobId)["status"]}
+
+@app.before_request
+def start_timer():
+    request.started = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    if metrics.enabled and request.endpoint is not None:
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - request.started, (request.endpoint,))
+    return response
+
+@app.route('/metrics')
+def metrics_endpoint():
+    #Prometheus text format; counts are per process, so scrape every gunicorn worker
+    return metrics.exposition(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
 
 @app.route('/getmodel')
 def get_model():
@@ -0,0 +1,153 @@
+#Repeatable benchmarks for the game engine and the trainers, written as JSON so runs can be compared
+#python benchmark.py --output results.json                        run everything and save the results
+#python benchmark.py --baseline baseline.json --threshold .2     also flag anything more than 20% slower than the baseline
+#python benchmark.py --quick                                     smaller trainer configurations, for a fast sanity check
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import timeit
+import tracemalloc
+from game import Budget, FitnessCache, playGame, calculateFitness, tournamentMatrix, successor, train_hill_climb, train_hill_climb_tabu_restart, train_hill_climb_tabu, train_simulated_annealing, train_basic_genetic, train_basic_genetic_mutation, train_island_genetic, local_beam_search
+from solver import solveBestResponse
+from players import Defector, Cooperator, GrimTrigger, TitForTat, TwoTitForTat, NiceTitForTat, SuspiciousTitForTat, myModels
+
+PAYOFFS = [[3, 0], [5, 1]]
+SEED = 12345
+ROUND_COUNTS = (20, 200)
+MIN_TIME = .05 #seconds each micro-benchmark keeps repeating for
+
+def opponentPool():
+    return [Defector(), Cooperator(), GrimTrigger(), TitForTat(), TwoTitForTat(), NiceTitForTat(), SuspiciousTitForTat()]
+
+def fixedModel(memSize):
+    return random.Random(SEED).getrandbits(memSize)
+
+def timePerCall(fn, minTime):
+    #best of three runs of at least minTime each, in seconds per call
+    timer = timeit.Timer(fn)
+    number = 1
+    while timer.timeit(number) < minTime:
+        number *= 2
+    return min(timer.repeat(repeat=3, number=number))/number
+
+def microBenchmarks(minTime):
+    results = {}
+    players = opponentPool() + [myModels[149](fixedModel(149))]
+    for i, p1 in enumerate(players):
+        for p2 in players[i:]:
+            for numRounds in ROUND_COUNTS:
+                name = f"playGame/{type(p1).__name__}-{type(p2).__name__}/{numRounds}"
+                results[name] = {"seconds": timePerCall(lambda: playGame(PAYOFFS, p1, p2, numRounds), minTime)}
+    models = opponentPool()
+    for memSize in sorted(myModels):
+        modelPlayer = myModels[memSize](fixedModel(memSize))
+        results[f"calculateFitness/{memSize}"] = {"seconds": timePerCall(lambda: calculateFitness(PAYOFFS, models, modelPlayer), minTime)}
+    rng = random.Random(SEED)
+    entrants = opponentPool() + [myModels[149](rng.getrandbits(149)) for _ in range(200)]
+    results[f"tournamentMatrix/{len(entrants)}"] = {"seconds": timePerCall(lambda: tournamentMatrix(PAYOFFS, entrants), minTime)}
+    return results
+
+def trainerConfigs(quick):
+    #name -> function taking (cache, budget); every trainer is seeded with SEED before it runs
+    scale = 1 if quick else 4
+    return {
+        "train_hill_climb": lambda cache, budget: train_hill_climb(2*scale, 5*scale, successor, PAYOFFS, 149, cache=cache, budget=budget),
+        "train_hill_climb_tabu_restart": lambda cache, budget: train_hill_climb_tabu_restart(2*scale, 5*scale, successor, PAYOFFS, 149, 100, cache=cache, budget=budget),
+        "train_hill_climb_tabu": lambda cache, budget: train_hill_climb_tabu(5*scale, successor, PAYOFFS, 149, 100, cache=cache, budget=budget),
+        "train_simulated_annealing": lambda cache, budget: train_simulated_annealing(scale, 100, successor, opponentPool(), PAYOFFS, 149, coolingMul=.99, cache=cache, budget=budget),
+        "train_basic_genetic": lambda cache, budget: train_basic_genetic(50*scale, 10*scale, .5, opponentPool(), PAYOFFS, 149, cache=cache, budget=budget),
+        "train_basic_genetic_mutation": lambda cache, budget: train_basic_genetic_mutation(50*scale, 10*scale, .5, .2, 5, opponentPool(), PAYOFFS, 149, cache=cache, budget=budget),
+        "train_island_genetic": lambda cache, budget: train_island_genetic(4, 50*scale//4, 10*scale, .5, .2, 5, opponentPool(), PAYOFFS, 149, cache=cache, budget=budget),
+        "local_beam_search": lambda cache, budget: local_beam_search(5*scale, 4, successor, opponentPool(), PAYOFFS, 149, cache=cache, budget=budget),
+        "solveBestResponse": lambda cache, budget: solveBestResponse(PAYOFFS, opponentPool(), 149, budget=budget)[:2],
+    }
+
+def runTrainer(train):
+    random.seed(SEED)
+    budget = Budget()
+    start = time.perf_counter()
+    model, fitness = train(FitnessCache(100000), budget)
+    seconds = time.perf_counter() - start
+    return model, fitness, budget.evaluations, seconds
+
+def macroBenchmarks(quick, repeat=3, memory=True):
+    #every run gets a fresh fitness cache so results don't depend on what ran before it; the fastest of
+    #`repeat` identical seeded runs is kept, and peak memory comes from one more, traced run, since
+    #tracemalloc slows everything down
+    results = {}
+    for name, train in trainerConfigs(quick).items():
+        model, fitness, evaluations, seconds = min((runTrainer(train) for _ in range(repeat)), key=lambda run: run[3])
+        result = {"seconds": seconds, "evaluations": evaluations, "evaluationsPerSecond": evaluations/seconds,
+                  "fitness": fitness, "model": hex(model)}
+        if memory:
+            tracemalloc.start()
+            runTrainer(train)
+            result["peakMemory"] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        results[name] = result
+    return results
+
+def compare(results, baseline, threshold):
+    #a benchmark regresses when it's more than threshold (a fraction) slower than the baseline,
+    #or, for a trainer, when the seeded run no longer ends on the same fitness
+    regressions = []
+    for group in ("micro", "macro"):
+        for name, result in results.get(group, {}).items():
+            old = baseline.get(group, {}).get(name)
+            if old is None:
+                continue
+            if result["seconds"] > old["seconds"]*(1 + threshold):
+                regressions.append(f"{name}: {old['seconds']:.6g}s -> {result['seconds']:.6g}s "
+                                   f"({result['seconds']/old['seconds'] - 1:+.0%})")
+            if "fitness" in old and result["fitness"] != old["fitness"]:
+                regressions.append(f"{name}: fitness {old['fitness']} -> {result['fitness']}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the game engine and the trainers")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON file from an earlier run to check for regressions against")
+    parser.add_argument("--threshold", type=float, default=.2, help="slowdown (as a fraction) counted as a regression")
+    parser.add_argument("--quick", action="store_true", help="smaller trainer runs")
+    parser.add_argument("--only", choices=("micro", "macro"), help="run just one group")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per trainer; the fastest is reported")
+    parser.add_argument("--no-memory", action="store_true", help="skip the traced runs that measure peak memory")
+    parser.add_argument("--min-time", type=float, default=MIN_TIME, help="seconds each micro-benchmark repeats for")
+    args = parser.parse_args(argv)
+
+    results = {"python": platform.python_version(), "platform": platform.platform(), "quick": args.quick,
+               "created": time.time()}
+    if args.only != "macro":
+        results["micro"] = microBenchmarks(args.min_time)
+    if args.only != "micro":
+        results["macro"] = macroBenchmarks(args.quick, repeat=args.repeat, memory=not args.no_memory)
+
+    for group in ("micro", "macro"):
+        for name, result in results.get(group, {}).items():
+            line = f"{name:<70} {result['seconds']*1e6:>14.1f} us"
+            if "evaluations" in result:
+                line += f" {result['evaluationsPerSecond']:>10.0f} evals/s  fitness {result['fitness']:.4f}"
+            if "peakMemory" in result:
+                line += f"  peak {result['peakMemory']/1e6:.1f} MB"
+            print(line)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("quick") != args.quick:
+            print("warning: baseline was run with a different --quick setting", file=sys.stderr)
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,42 @@
+#Ecological simulation: how a mixed population of strategies and trained genomes evolves when the fitter types
+#reproduce more. The pairwise payoff matrix is played once (tournamentMatrix), after which every generation is a
+#single matrix-vector product, so thousands of generations of hundreds of types take milliseconds
+#"discrete": each type's share next generation is proportional to its share times its average payoff
+#"replicator": the continuous replicator equation x' = x(f - x.f), stepped with Euler steps of size `step`
+import numpy as np
+from game import tournamentMatrix
+
+DYNAMICS = ("discrete", "replicator")
+EXTINCT = 1e-12 #shares below this are set to 0, so a type that has died out stays dead
+
+def populationShares(counts):
+    shares = np.array(counts, dtype=np.float64)
+    if len(shares) == 0 or (shares < 0).any() or shares.sum() <= 0:
+        raise ValueError("the population needs non-negative counts and at least one member")
+    return shares/shares.sum()
+
+def evolve(matrix, shares, generations, dynamics="discrete", step=.1):
+    #yields the shares after every generation (generation 0, the starting population, first) as NumPy arrays
+    if dynamics not in DYNAMICS:
+        raise ValueError(f"dynamics must be one of {', '.join(DYNAMICS)}")
+    #discrete reproduction needs positive fitness; shifting every payoff by the same amount keeps the ranking
+    matrix = np.asarray(matrix, dtype=np.float64)
+    if dynamics == "discrete" and matrix.size and matrix.min() <= 0:
+        matrix = matrix - matrix.min() + 1e-9
+    shares = populationShares(shares)
+    yield shares
+    for _ in range(generations):
+        fitness = matrix @ shares
+        average = shares @ fitness
+        if dynamics == "discrete":
+            shares = shares*fitness/average
+        else:
+            shares = shares + step*shares*(fitness - average)
+        shares[shares < EXTINCT] = 0
+        shares /= shares.sum()
+        yield shares
+
+def simulateEcology(payoffs, players, counts, generations, dynamics="discrete", step=.1, numRounds=100):
+    #the shares of each of `players` (starting in proportion to counts) over the generations, as a (generations+1, n) array
+    matrix = tournamentMatrix(payoffs, players, numRounds)
+    return np.array(list(evolve(matrix, counts, generations, dynamics, step)))
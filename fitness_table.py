@@ -0,0 +1,98 @@
+#Every 21-bit genome's games against every built-in strategy, worked out once and kept in a memory-mapped file
+#the file holds outcome counts rather than scores: counts[genome, column] = (CC, CD, DC, DD) from the model's side,
+#so one table serves every payoff matrix, and any pool is a weighted sum of its columns
+#np.load(mmap_mode="r") maps the file read-only, so every gunicorn worker shares the same pages
+#python fitness_table.py [--rounds 20] [--output fitness_table21.npy]    builds the table (about 70MB)
+import argparse
+import os
+import numpy as np
+from game import calculateFitness
+from players import Cooperator, Defector, GrimTrigger, TitForTat, TwoTitForTat, NiceTitForTat, SuspiciousTitForTat, ModelPlayer21, modelLayout, opponentCounts
+from vectorized import countOutcomesBatch, packGenomes, _side
+
+FITNESS_TABLE = os.environ.get("FITNESS_TABLE", "fitness_table21.npy")
+MEM_SIZE = 21
+COLUMNS = [Cooperator, Defector, GrimTrigger, TitForTat, TwoTitForTat, NiceTitForTat, SuspiciousTitForTat] #then self-play
+CHUNK = 1 << 16 #genomes played (or scored) at a time
+
+def buildTable(path, numRounds=20):
+    #the self-play column is numRounds//2 rounds, like calculateFitness
+    if not 2 <= numRounds <= 255:
+        raise ValueError("counts are stored as bytes, so games must be 2 to 255 rounds long")
+    layout = modelLayout(MEM_SIZE)
+    total = 1 << MEM_SIZE
+    counts = np.lib.format.open_memmap(path + ".tmp", mode="w+", dtype=np.uint8, shape=(total, len(COLUMNS)+1, 4))
+    for start in range(0, total, CHUNK):
+        packed = packGenomes(range(start, start + CHUNK), MEM_SIZE)
+        population = _side(None, packed, layout)
+        for column, Strategy in enumerate(COLUMNS):
+            counts[start:start + CHUNK, column] = countOutcomesBatch(population, _side(Strategy(), packed, layout), numRounds, CHUNK)
+        counts[start:start + CHUNK, -1] = countOutcomesBatch(population, population, numRounds//2, CHUNK)
+    counts.flush()
+    del counts
+    os.replace(path + ".tmp", path) #workers never see a half-written table; running ones keep their old mapping until restarted
+    tables.pop(path, None)
+    return openTable(path)
+
+class FitnessTable:
+    def __init__(self, path):
+        self.path = path
+        self.counts = np.load(path, mmap_mode="r")
+        if self.counts.shape != (1 << MEM_SIZE, len(COLUMNS)+1, 4):
+            raise ValueError(f"{path} isn't a {MEM_SIZE}-bit fitness table")
+        self.numRounds = int(self.counts[0, 0].sum()) #every game in a column lasts the same number of rounds
+        self.selfRounds = int(self.counts[0, -1].sum())
+
+    def weights(self, models):
+        #one weight per column for a pool of built-in strategies (or (player, count) pairs)
+        weights = [0]*len(COLUMNS)
+        for opponent, count in opponentCounts(models):
+            if type(opponent) not in COLUMNS:
+                raise ValueError(f"{type(opponent).__name__} isn't in the fitness table")
+            weights[COLUMNS.index(type(opponent))] += count
+        return weights
+
+    def fitness(self, payoffs, models, start=0, stop=None):
+        #calculateFitness for genomes start..stop-1 (all of them by default), as an array
+        weights = self.weights(models)
+        perRound = np.array([payoffs[0][0], payoffs[0][1], payoffs[1][0], payoffs[1][1]], dtype=np.float64)
+        counts = self.counts[start:stop]
+        score = np.zeros(len(counts))
+        for column, count in enumerate(weights):
+            if count:
+                score += count*(counts[:, column] @ perRound)/self.numRounds
+        score += (counts[:, -1] @ perRound)/self.selfRounds
+        return score/(sum(weights)+1)
+
+    def best(self, payoffs, models):
+        #(genome, fitness) of the best 21-bit genome; ties go to the lowest genome
+        bestModel, bestFitness = 0, float("-inf")
+        for start in range(0, len(self.counts), CHUNK):
+            scores = self.fitness(payoffs, models, start, start + CHUNK)
+            i = int(np.argmax(scores))
+            if scores[i] > bestFitness:
+                bestModel, bestFitness = start + i, scores[i]
+        return bestModel, bestFitness
+
+tables = {}
+
+def openTable(path=FITNESS_TABLE):
+    #each process maps a file once
+    if path not in tables:
+        tables[path] = FitnessTable(path)
+    return tables[path]
+
+def train_table_lookup(models, payoffs, numRounds=20, path=FITNESS_TABLE):
+    #the exact best 21-bit genome for the pool, read off the table instead of searched for
+    table = openTable(path)
+    if table.numRounds != numRounds:
+        raise ValueError(f"{path} was built for {table.numRounds} rounds, not {numRounds}")
+    model, _ = table.best(payoffs, models)
+    return (model, calculateFitness(payoffs, models, ModelPlayer21(model), numRounds))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the 21-bit fitness table")
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--output", default=FITNESS_TABLE)
+    args = parser.parse_args()
+    buildTable(args.output, args.rounds)
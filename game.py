@@ -1,68 +1,111 @@
 #Stores most model training functions (apart from GA, hill climb, and simulated annealing)
 import random
 import time
+import copy
+import heapq
+import multiprocessing
+import os
+import threading
+import weakref
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import repeat
 from math import e, ceil
-from players import Player, Defector, Cooperator, GrimTrigger, RandomChooser, TitForTat, TwoTitForTat, NiceTitForTat, SuspiciousTitForTat, myModels
+import metrics
+from players import Player, Defector, Cooperator, GrimTrigger, RandomChooser, TitForTat, TwoTitForTat, NiceTitForTat, SuspiciousTitForTat, myModels, isDeterministic, opponentCounts
+from vectorized import evaluatePopulation, isVectorizable, tournamentOutcomeBatch, swapOutcomes
 #In general, past_moves[0] = your own moves, past_moves[1] = opponent's moves
+CYCLE_MIN_ROUNDS = 20 #games longer than this are scored by cycle detection instead of playing every round
 #region LRUCache
-class Node:
-    def __init__(self, key: int, value: int):
-        self.key = key
-        self.value = value 
-        self.prev = None
-        self.next = None
+#every cache's lock, so a process forked while some other thread held one doesn't start out with it held for good
+cacheLocks = weakref.WeakSet()
+
+def resetCacheLocks():
+    for cache in list(cacheLocks):
+        cache.lock = threading.Lock()
+
+os.register_at_fork(after_in_child=resetCacheLocks)
 
 class LRUCache:
+    #OrderedDict keeps the recency order in C, so this stays cheap with hundreds of thousands of entries
+    #the module-level caches are shared by every request thread of a gthread worker, so get and put hold a lock
     def __init__(self, capacity: int):
         self.capacity = capacity
-        self.keyToNode = {}
-        self.head = Node(-1, -1)
-        self.tail = Node(-1, -1)
-        self.join(self.head, self.tail)
-
-    def get(self, key: int) -> int:
-        if key not in self.keyToNode:
-            return -1
-        node = self.keyToNode[key]
-        self.remove(node)
-        self.moveToHead(node)
-        return node.value
-
-    def put(self, key: int, value: int) -> None:
-        if key in self.keyToNode:
-            node = self.keyToNode[key]
-            node.value = value
-            self.remove(node)
-            self.moveToHead(node)
-            return
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        cacheLocks.add(self)
 
-        if len(self.keyToNode) == self.capacity:
-            lastNode = self.tail.prev
-            del self.keyToNode[lastNode.key]
-            self.remove(lastNode)
+    def get(self, key, default=-1):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            self.entries.move_to_end(key)
+            return self.entries[key]
 
-        self.moveToHead(Node(key, value))
-        self.keyToNode[key] = self.head.next
+    def put(self, key, value) -> None:
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+            elif len(self.entries) >= self.capacity:
+                self.entries.popitem(last=False)
+            self.entries[key] = value
 
-    def join(self, node1: Node, node2: Node):
-        node1.next = node2
-        node2.prev = node1
+    def __contains__(self, key):
+        return key in self.entries
 
-    def moveToHead(self, node: Node):
-        self.join(node, self.head.next)
-        self.join(self.head, node)
+    def __len__(self):
+        return len(self.entries)
 
-    def remove(self, node: Node):
-        self.join(node.prev, node.next)
+    def __getstate__(self):
+        #a lock can't be pickled; the copy gets its own
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+        cacheLocks.add(self)
+
+class SizedLRUCache(LRUCache):
+    #capacity bounds the total size(value) of the entries instead of how many there are; a value bigger than the
+    #whole capacity isn't kept at all
+    def __init__(self, capacity: int, size):
+        super().__init__(capacity)
+        self.size = size
+        self.total = 0
+
+    def put(self, key, value) -> None:
+        weight = self.size(value)
+        with self.lock:
+            if key in self.entries:
+                self.total -= self.size(self.entries.pop(key))
+            if weight > self.capacity:
+                return
+            while self.total + weight > self.capacity:
+                self.total -= self.size(self.entries.popitem(last=False)[1])
+            self.entries[key] = value
+            self.total += weight
+#endregion
 
-        
 def playGame(payoffs, player1: Player, player2: Player, numRounds: int):
+    state1 = player1.initial_state()
+    state2 = player2.initial_state()
+    if state1 is not None and state2 is not None:
+        if metrics.enabled:
+            metrics.gamePlayed("compact", numRounds)
+        return playGameCompact(payoffs, player1, player2, numRounds, state1, state2)
+    if metrics.enabled:
+        metrics.gamePlayed("history", numRounds)
     score1 = 0
     score2 = 0
     past_moves = [[-1 for i in range(numRounds)], [-1 for i in range(numRounds)]]
+    opponent_view = [past_moves[1], past_moves[0]]
     for i in range(numRounds):
         action1 = player1.get_action(past_moves, i)
-        action2 = player2.get_action(past_moves[::-1], i)
+        action2 = player2.get_action(opponent_view, i)
         past_moves[0][i] = action1
         past_moves[1][i] = action2 
         score1 += payoffs[action1][action2]
@@ -70,70 +113,821 @@ def playGame(payoffs, player1: Player, player2: Player, numRounds: int):
     # print(player1, player2)
     return (score1/numRounds, score2/numRounds)
 
+def playGameCompact(payoffs, player1: Player, player2: Player, numRounds: int, state1, state2):
+    #playGame for two players that carry their own state, so no history is kept and each round is O(1)
+    score1 = 0
+    score2 = 0
+    for i in range(numRounds):
+        action1 = player1.next_move(state1)
+        action2 = player2.next_move(state2)
+        score1 += payoffs[action1][action2]
+        score2 += payoffs[action2][action1]
+        state1 = player1.next_state(state1, action1, action2)
+        state2 = player2.next_state(state2, action2, action1)
+    return (score1/numRounds, score2/numRounds)
+
+remainingRanges = LRUCache(256)
+
+def scoreRanges(payoffs, opponent: Player, numRounds: int):
+    #ranges[i][state] = (least, most) a player can still score from round i on against a deterministic opponent that's
+    #in `state`, whatever it plays; worked out backwards over the states the opponent can reach, so they're exact
+    key = (tuple(map(tuple, payoffs)), playerKey(opponent), numRounds)
+    ranges = remainingRanges.get(key, None)
+    if ranges is not None:
+        return ranges
+    layers = [{opponent.initial_state()}]
+    for _ in range(numRounds - 1):
+        layers.append({opponent.next_state(state, opponent.next_move(state), mine) for state in layers[-1] for mine in (0, 1)})
+    ranges = [None]*numRounds
+    after = None
+    for i in range(numRounds - 1, -1, -1):
+        ranges[i] = {}
+        for state in layers[i]:
+            theirs = opponent.next_move(state)
+            low0, high0 = after[opponent.next_state(state, theirs, 0)] if after is not None else (0, 0)
+            low1, high1 = after[opponent.next_state(state, theirs, 1)] if after is not None else (0, 0)
+            ranges[i][state] = (min(payoffs[0][theirs] + low0, payoffs[1][theirs] + low1), max(payoffs[0][theirs] + high0, payoffs[1][theirs] + high1))
+        after = ranges[i]
+    remainingRanges.put(key, ranges)
+    return ranges
+
+def findCycle(player1: Player, player2: Player, numRounds: int):
+    #plays until the joint state of both players repeats, so the rest of the game is that cycle over and over
+    #returns (moves, cycleStart) with moves[cycleStart:] being one period, or cycleStart = None if the game ended first
+    #returns None if either player doesn't carry a compact state (e.g. RandomChooser)
+    state1 = player1.initial_state()
+    state2 = player2.initial_state()
+    if state1 is None or state2 is None:
+        return None
+    moves = []
+    counters = []
+    seen = {}
+    for i in range(numRounds):
+        counter = (state1[1], state2[1])
+        key = (state1[0], state2[0], tuple(c is not None and c > 0 for c in counter))
+        if key in seen:
+            start = seen[key]
+            if all(_counterRepeats([c[k] for c in counters[start:]], counter[k] - counters[start][k])
+                   for k in range(2) if counter[k] is not None):
+                return (moves, start)
+        seen[key] = i
+        counters.append(counter)
+
+        action1 = player1.next_move(state1)
+        action2 = player2.next_move(state2)
+        moves.append((action1, action2))
+        state1 = player1.next_state(state1, action1, action2)
+        state2 = player2.next_state(state2, action2, action1)
+    return (moves, None)
+
+def replayGame(payoffs, player1: Player, player2: Player, numRounds: int):
+    #the game findCycle plays, as it's played: yields {"round", "moves", "payoffs"} for every round up to the first
+    #repeated state, then (if there's one) {"cycle": {"start", "length", "repeats", "rest"}} meaning rounds
+    #start..start+length-1 come round again `repeats` more times followed by the first `rest` of them, and last
+    #{"scores": [...]} with both players' average scores; memory only grows with the rounds before the cycle
+    state1 = player1.initial_state()
+    state2 = player2.initial_state()
+    if state1 is None or state2 is None:
+        raise ValueError("replays need players that carry a compact state")
+    counters = []
+    totals = [(0, 0)] #totals[i] = both scores after i rounds
+    seen = {}
+    for i in range(numRounds):
+        counter = (state1[1], state2[1])
+        key = (state1[0], state2[0], tuple(c is not None and c > 0 for c in counter))
+        if key in seen:
+            start = seen[key]
+            if all(_counterRepeats([c[k] for c in counters[start:]], counter[k] - counters[start][k])
+                   for k in range(2) if counter[k] is not None):
+                length = i - start
+                repeats, rest = divmod(numRounds - i, length)
+                yield {"cycle": {"start": start, "length": length, "repeats": repeats, "rest": rest}}
+                cycle = [totals[i][k] - totals[start][k] for k in range(2)]
+                partial = [totals[start + rest][k] - totals[start][k] for k in range(2)]
+                yield {"scores": [(totals[i][k] + repeats*cycle[k] + partial[k])/numRounds for k in range(2)]}
+                return
+        seen[key] = i
+        counters.append(counter)
+
+        action1 = player1.next_move(state1)
+        action2 = player2.next_move(state2)
+        round1, round2 = payoffs[action1][action2], payoffs[action2][action1]
+        totals.append((totals[-1][0] + round1, totals[-1][1] + round2))
+        yield {"round": i, "moves": [action1, action2], "payoffs": [round1, round2]}
+        state1 = player1.next_state(state1, action1, action2)
+        state2 = player2.next_state(state2, action2, action1)
+    yield {"scores": [total/numRounds for total in totals[-1]]}
+
+def _counterRepeats(values, delta):
+    #a counter that moved by delta over one period keeps giving the same > 0 answers every later period
+    if delta > 0:
+        return all(v > 0 for v in values)
+    if delta < 0:
+        return all(v <= 0 for v in values)
+    return True
+
+def playGameCycle(payoffs, player1: Player, player2: Player, numRounds: int):
+    #same result as playGame, but only simulates up to the first repeated state and extrapolates the cycle
+    trajectory = findCycle(player1, player2, numRounds)
+    if trajectory is None:
+        return playGame(payoffs, player1, player2, numRounds)
+    moves, cycleStart = trajectory
+    if metrics.enabled:
+        metrics.gamePlayed("cycle", len(moves))
+    rounds = [(payoffs[a1][a2], payoffs[a2][a1]) for a1, a2 in moves]
+    if cycleStart is None:
+        score1 = sum(r[0] for r in rounds)
+        score2 = sum(r[1] for r in rounds)
+    else:
+        prefix, cycle = rounds[:cycleStart], rounds[cycleStart:]
+        repeats, rest = divmod(numRounds - cycleStart, len(cycle))
+        score1 = sum(r[0] for r in prefix) + repeats*sum(r[0] for r in cycle) + sum(r[0] for r in cycle[:rest])
+        score2 = sum(r[1] for r in prefix) + repeats*sum(r[1] for r in cycle) + sum(r[1] for r in cycle[:rest])
+    return (score1/numRounds, score2/numRounds)
+
+def scoreGame(payoffs, player1: Player, player2: Player, numRounds: int):
+    #short games are cheaper to just play out than to track states for
+    if numRounds <= CYCLE_MIN_ROUNDS:
+        return playGame(payoffs, player1, player2, numRounds)
+    return playGameCycle(payoffs, player1, player2, numRounds)
+
 def calculateAllFitnesses(payoffs, models):
+    #each player in the pool plays 1 game against each other, once from either side
+    #deterministic games play the same from both sides, so every pair's scores count twice
+    return [2*score for score in tournamentMatrix(payoffs, models, 100).sum(axis=1).tolist()]
+
+#the moves in a game never depend on the payoffs, so a game between deterministic players comes down to how often
+#each pair of moves came up; those (CC, CD, DC, DD) counts are kept per pair of players and number of rounds, and a
+#score for any payoff matrix is then counts @ payoffVector(payoffs)/numRounds
+outcomeCache = LRUCache(100000)
+#whole tournaments, so replaying one under other payoffs doesn't play any games; bounded by bytes, since one
+#(n, n, 4) array of a big tournament outweighs thousands of small ones
+tournamentCache = SizedLRUCache(32 << 20, lambda counts: counts.nbytes)
+
+def playerKey(player):
+    #players with the same key play every game the same way
+    return (type(player), getattr(player, "model", None)) if isDeterministic(player) else id(player)
+
+def payoffVector(payoffs):
+    #(CC, CD, DC, DD) payoffs from the first player's side, to dot with outcome counts
+    return np.array([payoffs[0][0], payoffs[0][1], payoffs[1][0], payoffs[1][1]], dtype=np.float64)
+
+def countOutcomes(player1: Player, player2: Player, numRounds: int):
+    #(CC, CD, DC, DD) counts for player1's game against player2, from player1's side; None unless both are deterministic
+    if not (isDeterministic(player1) and isDeterministic(player2)):
+        return None
+    key = (playerKey(player1), playerKey(player2), numRounds)
+    counts = outcomeCache.get(key, None)
+    if counts is not None:
+        return counts
+    moves, cycleStart = findCycle(player1, player2, numRounds)
+    if metrics.enabled:
+        metrics.gamePlayed("cycle", len(moves))
+    tally = [0, 0, 0, 0]
+    if cycleStart is None:
+        for a1, a2 in moves:
+            tally[(a1 << 1) | a2] += 1
+    else:
+        cycle = moves[cycleStart:]
+        repeats, rest = divmod(numRounds - cycleStart, len(cycle))
+        for a1, a2 in moves[:cycleStart] + cycle[:rest]:
+            tally[(a1 << 1) | a2] += 1
+        for a1, a2 in cycle:
+            tally[(a1 << 1) | a2] += repeats
+    counts = tuple(tally)
+    outcomeCache.put(key, counts)
+    outcomeCache.put((key[1], key[0], numRounds), (counts[0], counts[2], counts[1], counts[3]))
+    return counts
+
+def _distinctPlayers(models):
+    #(distinct, index): one player per way of playing, and which of them each of models is
+    distinct = []
+    index = []
+    keys = {}
+    for player in models:
+        key = playerKey(player)
+        if key not in keys:
+            keys[key] = len(distinct)
+            distinct.append(player)
+        index.append(keys[key])
+    return distinct, index
+
+def tournamentOutcomes(models, numRounds=100):
+    #counts[i, j] = (CC, CD, DC, DD) in models[i]'s game against models[j] (self-play on the diagonal) from models[i]'s
+    #side, as an (n, n, 4) array; every player has to be deterministic
+    #games with a ModelPlayer are batched by tournamentOutcomeBatch, the rest go through countOutcomes
+    distinct, index = _distinctPlayers(models)
+    if not all(isDeterministic(player) for player in distinct):
+        raise ValueError("outcome counts need deterministic players")
+    key = (tuple(playerKey(player) for player in distinct), numRounds)
+    counts = tournamentCache.get(key, None)
+    if counts is None:
+        counts = tournamentOutcomeBatch(distinct, numRounds)
+        for i in range(len(distinct)):
+            for j in range(i, len(distinct)):
+                if counts[i, j, 0] < 0:
+                    counts[i, j] = countOutcomes(distinct[i], distinct[j], numRounds)
+                    counts[j, i] = swapOutcomes(counts[i, j])
+        counts.setflags(write=False)
+        tournamentCache.put(key, counts)
+    return counts[np.ix_(index, index)]
+
+def tournamentMatrix(payoffs, models, numRounds=100):
+    #scores[i, j] = models[i]'s average score in its game against models[j] (self-play on the diagonal), as a NumPy array
+    #games between deterministic players come from their outcome counts (tournamentOutcomes), so a tournament that
+    #was already played under other payoffs isn't played again; games with a random player go through scoreGame
+    distinct, index = _distinctPlayers(models)
+    deterministic = [i for i, player in enumerate(distinct) if isDeterministic(player)]
+    scores = np.full((len(distinct), len(distinct)), np.nan)
+    if deterministic:
+        counts = tournamentOutcomes([distinct[i] for i in deterministic], numRounds)
+        scores[np.ix_(deterministic, deterministic)] = counts @ payoffVector(payoffs)/numRounds
+    for i in range(len(distinct)):
+        for j in range(i, len(distinct)):
+            if np.isnan(scores[i, j]):
+                scores[i, j], scores[j, i] = scoreGame(payoffs, distinct[i], distinct[j], numRounds)
+    return scores[np.ix_(index, index)]
+
+def calculateFitness(payoffs, models, modelPlayer, numRounds=20):
     #each player in the pool plays 1 game against each other
-    scores = [0 for i in range(len(models))]
-    
-    for i in range(len(models)):
-        for j in range(len(models)):
-            score1, score2 = playGame(payoffs, models[i], models[j], 100)
-            scores[i] += score1 
-            scores[j] += score2 
-    return scores
-
-def calculateFitness(payoffs, models, modelPlayer):
-    #each player in the pool plays 1 game against each other
+    #the model also plays itself for numRounds//2 rounds
+    #models can also be given as (player, count) pairs; a deterministic opponent is only played once and weighted by its count
 
+    start = time.perf_counter() if metrics.enabled else None
     score = 0
-    for i in range(len(models)):
-        score1, score2 = playGame(payoffs, models[i], modelPlayer, 20)
-        score += score2 
-    score += playGame(payoffs, modelPlayer, modelPlayer, 10)[0]
-    return score/(len(models)+1)
-
-def successor(model, memSize):
-    model = model ^ (1 << random.randint(0, memSize-1))
+    pool = opponentCounts(models)
+    for opponent, count in pool:
+        score1, score2 = scoreGame(payoffs, opponent, modelPlayer, numRounds)
+        score += count*score2 
+    score += scoreGame(payoffs, modelPlayer, modelPlayer, numRounds//2)[0]
+    if start is not None:
+        metrics.FITNESS_EVALUATIONS.inc(labels=("full",))
+        metrics.FITNESS_SECONDS.observe(time.perf_counter() - start)
+    return score/(sum(count for _, count in pool)+1)
+
+class NeighborFitness:
+    #plays calculateFitness for a parent model while tracking which genome bits each game looked up.
+    #any model that only differs from the parent in bits a game never read gets that game's score for free,
+    #so only the games that read a flipped bit are replayed
+    #a cache with a compare method (a noisy fitness, see montecarlo.StochasticFitness) can't be patched up game by
+    #game: fitnesses() then has it compare the parent and every candidate side by side instead
+    def __init__(self, payoffs, models, modelPlayer, numRounds=20, cache=None):
+        self.payoffs = payoffs
+        self.pool = opponentCounts(models)
+        self.numPlayers = sum(count for _, count in self.pool)+1
+        self.numRounds = numRounds
+        self.ModelPlayer = type(modelPlayer)
+        self.model = modelPlayer.model
+        self.compare = getattr(cache, "compare", None)
+        if self.compare is not None:
+            self.parentFitness = None #estimated along with the candidates
+            return
+        self.scores = []
+        self.reads = []
+        for opponent, count in self.pool:
+            modelPlayer.reads = 0
+            self.scores.append(scoreGame(payoffs, opponent, modelPlayer, numRounds)[1])
+            self.reads.append(modelPlayer.reads)
+        modelPlayer.reads = 0
+        self.scores.append(scoreGame(payoffs, modelPlayer, modelPlayer, numRounds//2)[0])
+        self.reads.append(modelPlayer.reads)
+        modelPlayer.reads = None
+        self.parentFitness = self.total(self.scores)
+        self.weights = [count for _, count in self.pool] + [1]
+        self.gameRounds = [numRounds]*len(self.pool) + [numRounds//2]
+        self.bounds = None #set up by the first evaluate()
+        self.gamesReplayed = 0
+        self.cache = cache
+        if cache is not None:
+            self.keyBase = cache.key(payoffs, models, modelPlayer, numRounds)
+            if self.keyBase is not None:
+                cache.put(self.keyBase, self.parentFitness)
+
+    def fitnesses(self, candidates):
+        #fitness for every candidate; a noisy fitness also re-estimates parentFitness in the same comparison
+        if self.compare is None:
+            return [self.fitness(candidate) for candidate in candidates]
+        estimates = self.compare(self.payoffs, self.pool, [self.model] + candidates, self.ModelPlayer.memSize, self.numRounds)
+        self.parentFitness = estimates[0]
+        return estimates[1:]
+
+    def fitness(self, model):
+        if self.compare is not None:
+            return self.fitnesses([model])[0]
+        fitness = self.lookup(model)
+        if fitness is None:
+            fitness = self.replay(model)
+            self.store(model, fitness)
+        return fitness
+
+    def replay(self, model):
+        if metrics.enabled:
+            metrics.FITNESS_EVALUATIONS.inc(labels=("incremental",))
+        changed = model ^ self.model
+        scores = None
+        for i, reads in enumerate(self.reads):
+            if reads & changed:
+                if scores is None:
+                    scores = self.scores[:]
+                    modelPlayer = self.ModelPlayer(model)
+                if i < len(self.pool):
+                    scores[i] = scoreGame(self.payoffs, self.pool[i][0], modelPlayer, self.numRounds)[1]
+                else:
+                    scores[i] = scoreGame(self.payoffs, modelPlayer, modelPlayer, self.numRounds//2)[0]
+                self.gamesReplayed += 1
+        if scores is None:
+            return self.parentFitness
+        return self.total(scores)
+
+    def evaluate(self, model, threshold, floor=None):
+        #(fitness, True), or (bound, False) as soon as the model provably scores below threshold (and above floor, if
+        #given), bound being the most its fitness could still come to; games are replayed one by one, and round by
+        #round against deterministic opponents, checking the score so far plus the most and least the rest can add
+        fitness = self.lookup(model)
+        if fitness is not None:
+            return fitness, True
+        changed = model ^ self.model
+        todo = [i for i, reads in enumerate(self.reads) if reads & changed]
+        if not todo:
+            return self.parentFitness, True
+        if metrics.enabled:
+            metrics.FITNESS_EVALUATIONS.inc(labels=("incremental",))
+        if self.bounds is None:
+            self.prepareBounds()
+        #everything is compared as weighted game totals, i.e. fitness*numPlayers
+        below = threshold*self.numPlayers - BOUND_MARGIN
+        above = floor*self.numPlayers + BOUND_MARGIN if floor is not None else float("-inf")
+        scores = self.scores[:]
+        known = sum(weight*score for i, (weight, score) in enumerate(zip(self.weights, scores)) if i not in todo)
+        restLow = sum(self.spans[i][0] for i in todo)
+        restHigh = sum(self.spans[i][1] for i in todo)
+        player = self.ModelPlayer(model)
+        for i in todo:
+            restLow -= self.spans[i][0]
+            restHigh -= self.spans[i][1]
+            score, upper = self.replayBounded(i, player, known + restLow, known + restHigh, below, above)
+            if score is None:
+                if metrics.enabled:
+                    metrics.FITNESS_EVALUATIONS.inc(labels=("pruned",))
+                return upper/self.numPlayers, False
+            scores[i] = score
+            known += self.weights[i]*score
+        fitness = self.total(scores)
+        self.store(model, fitness)
+        return fitness, True
+
+    def replayBounded(self, i, player, low, high, below, above):
+        #game i's score for player, or (None, upper) once low/high (the least and most the other games still left can
+        #add to the weighted total) make the total provably below `below` and above `above`
+        self.gamesReplayed += 1
+        scale = self.weights[i]/self.gameRounds[i]
+        ranges = self.bounds[i]
+        if ranges is None:
+            #a random opponent or a long game: only bounded as a whole
+            upper = high + self.spans[i][1]
+            if upper < below and low + self.spans[i][0] > above:
+                return None, upper
+            if i < len(self.pool):
+                return scoreGame(self.payoffs, self.pool[i][0], player, self.gameRounds[i])[1], None
+            return scoreGame(self.payoffs, player, player, self.gameRounds[i])[0], None
+        #playGameCompact with the check before every round; the same sums, so the same score
+        payoffs = self.payoffs
+        numRounds = self.gameRounds[i]
+        opponent = self.pool[i][0] if i < len(self.pool) else player
+        state1 = opponent.initial_state()
+        state2 = player.initial_state()
+        total = 0
+        for r in range(numRounds):
+            least, most = ranges[r][state1] if i < len(self.pool) else ranges[r]
+            upper = high + scale*(total + most)
+            if upper < below and low + scale*(total + least) > above:
+                if metrics.enabled:
+                    metrics.gamePlayed("bounded", r)
+                return None, upper
+            action1 = opponent.next_move(state1)
+            action2 = player.next_move(state2)
+            total += payoffs[action2][action1] if i < len(self.pool) else payoffs[action1][action2]
+            state1 = opponent.next_state(state1, action1, action2)
+            state2 = player.next_state(state2, action2, action1)
+        if metrics.enabled:
+            metrics.gamePlayed("bounded", numRounds)
+        return total/numRounds, None
+
+    def prepareBounds(self):
+        #per game: the least and most it can add to the weighted total (spans), and the per-round tables replayBounded
+        #checks against (bounds): scoreRanges against a deterministic opponent, the payoff extremes for self-play
+        lowest = min(min(row) for row in self.payoffs)
+        highest = max(max(row) for row in self.payoffs)
+        self.spans = []
+        self.bounds = []
+        for i, (weight, numRounds) in enumerate(zip(self.weights, self.gameRounds)):
+            scale = weight/numRounds
+            if numRounds > CYCLE_MIN_ROUNDS or (i < len(self.pool) and not isDeterministic(self.pool[i][0])):
+                self.bounds.append(None)
+                self.spans.append((weight*lowest, weight*highest))
+            elif i < len(self.pool):
+                ranges = scoreRanges(self.payoffs, self.pool[i][0], numRounds)
+                least, most = ranges[0][self.pool[i][0].initial_state()]
+                self.bounds.append(ranges)
+                self.spans.append((scale*least, scale*most))
+            else:
+                self.bounds.append([(lowest*(numRounds - r), highest*(numRounds - r)) for r in range(numRounds)])
+                self.spans.append((weight*lowest, weight*highest))
+
+    def lookup(self, model):
+        if self.cache is None or self.keyBase is None:
+            return None
+        return self.cache.get((model,) + self.keyBase[1:])
+
+    def store(self, model, fitness):
+        if self.cache is not None and self.keyBase is not None:
+            self.cache.put((model,) + self.keyBase[1:], fitness)
+
+    def total(self, scores):
+        #same arithmetic as calculateFitness so reused and replayed scores compare exactly
+        score = 0
+        for (opponent, count), gameScore in zip(self.pool, scores):
+            score += count*gameScore
+        return (score + scores[-1])/self.numPlayers
+
+BOUND_MARGIN = 1e-9 #bounds are compared with this much room, so float rounding never prunes a model that ties
+
+def scoreNeighborhood(neighbors, candidates, keep):
+    #neighbors.fitnesses(candidates) for a trainer that only looks at the `keep` fittest of the parent and candidates
+    #and at the least fit one: a candidate is evaluated against the current keep-th best as its threshold and the
+    #least fitness so far as its floor, and one that provably falls between them gets the most its fitness could
+    #be instead; that's neither in the top `keep` nor the least, so sorting the results picks the same models with
+    #the same weights as full evaluation
+    if neighbors.compare is not None:
+        return neighbors.fitnesses(candidates)
+    top = [neighbors.parentFitness]
+    lowest = neighbors.parentFitness
+    results = []
+    for model in candidates:
+        if len(top) < keep:
+            fitness = neighbors.fitness(model)
+        else:
+            fitness, exact = neighbors.evaluate(model, top[0], lowest)
+            if not exact:
+                results.append(fitness)
+                continue
+        results.append(fitness)
+        lowest = min(lowest, fitness)
+        if len(top) < keep:
+            heapq.heappush(top, fitness)
+        elif fitness > top[0]:
+            heapq.heapreplace(top, fitness)
+    return results
+
+def opponentKey(models):
+    #the opponent multiset as a hashable key, or None if any opponent doesn't play deterministically
+    pool = opponentCounts(models)
+    if not all(isDeterministic(m) for m, _ in pool):
+        return None
+    return tuple(sorted(((type(m).__name__, getattr(m, "model", None)), count) for m, count in pool))
+
+class FitnessCache:
+    #bounded memo of calculateFitness shared by every trainer
+    #keyed by (genome, memSize, payoffs, opponent multiset, numRounds); pools with random players are never cached
+    def __init__(self, capacity: int):
+        self.scores = LRUCache(capacity)
+        self.hits = 0
+        self.misses = 0
+        self.last = None #(models, len(models), opponentKey(models)) for the pool list last asked about
+
+    def key(self, payoffs, models, modelPlayer, numRounds=20):
+        pool = self.poolKey(payoffs, models, modelPlayer.memSize, numRounds)
+        return None if pool is None else (modelPlayer.model,) + pool
+
+    def poolKey(self, payoffs, models, memSize, numRounds=20):
+        #everything in the key except the genome itself
+        #trainers pass the same pool list on every call, so its key is only worked out once; the memo is read and
+        #replaced as one tuple, so a thread working on another pool can't hand this call its key
+        last = self.last
+        if last is None or models is not last[0] or len(models) != last[1]:
+            last = self.last = (models, len(models), opponentKey(models))
+        opponents = last[2]
+        if opponents is None:
+            return None
+        return (memSize, tuple(map(tuple, payoffs)), opponents, numRounds)
+
+    def get(self, key):
+        fitness = self.scores.get(key, None)
+        if fitness is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        if metrics.enabled:
+            metrics.CACHE_REQUESTS.inc(labels=("miss" if fitness is None else "hit",))
+        return fitness
+
+    def put(self, key, fitness):
+        self.scores.put(key, fitness)
+
+    def __call__(self, payoffs, models, modelPlayer, numRounds=20):
+        key = self.key(payoffs, models, modelPlayer, numRounds)
+        if key is None:
+            return calculateFitness(payoffs, models, modelPlayer, numRounds)
+        fitness = self.get(key)
+        if fitness is None:
+            fitness = calculateFitness(payoffs, models, modelPlayer, numRounds)
+            self.put(key, fitness)
+        return fitness
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hitRate": self.hits/lookups if lookups else 0.0,
+                "size": len(self.scores), "capacity": self.scores.capacity}
+
+    def __reduce__(self):
+        #a cache handed to a worker process starts out empty instead of copying every entry over
+        return (FitnessCache, (self.scores.capacity,))
+
+    def clear(self):
+        self.scores = LRUCache(self.scores.capacity)
+        self.hits = 0
+        self.misses = 0
+
+fitnessCache = FitnessCache(100000) #shared by all trainers unless they're given cache=None
+
+class GameCache:
+    #calculateFitness memoised per game instead of per pool: keyed by (genome, memSize, payoffs, opponent, numRounds),
+    #so pools that mix the same opponents in other proportions share every game they have in common
+    #it can stand in for FitnessCache as any trainer's cache; games against random players are never cached, and
+    #trainers that look up whole pools (key/poolKey) just don't get any hits from it
+    def __init__(self, capacity: int):
+        self.scores = LRUCache(capacity)
+        self.hits = 0
+        self.misses = 0
+        self.last = None #(models, len(models), opponentCounts(models)), as in FitnessCache.poolKey
+
+    def key(self, payoffs, models, modelPlayer, numRounds=20):
+        return None
+
+    def poolKey(self, payoffs, models, memSize, numRounds=20):
+        return None
+
+    def gameScore(self, payoffs, payoffKey, opponent, modelPlayer, numRounds):
+        #modelPlayer's score against opponent, or against itself for numRounds//2 rounds when opponent is None
+        if opponent is not None and not isDeterministic(opponent):
+            return scoreGame(payoffs, opponent, modelPlayer, numRounds)[1]
+        key = (modelPlayer.model, modelPlayer.memSize, payoffKey, None if opponent is None else playerKey(opponent), numRounds)
+        score = self.scores.get(key, None)
+        if metrics.enabled:
+            metrics.CACHE_REQUESTS.inc(labels=("miss" if score is None else "hit",))
+        if score is not None:
+            self.hits += 1
+            return score
+        self.misses += 1
+        if opponent is None:
+            score = scoreGame(payoffs, modelPlayer, modelPlayer, numRounds//2)[0]
+        else:
+            score = scoreGame(payoffs, opponent, modelPlayer, numRounds)[1]
+        self.scores.put(key, score)
+        return score
+
+    def __call__(self, payoffs, models, modelPlayer, numRounds=20):
+        #same arithmetic as calculateFitness, so it gives exactly the same fitness
+        last = self.last
+        if last is None or models is not last[0] or len(models) != last[1]:
+            last = self.last = (models, len(models), opponentCounts(models))
+        pool = last[2]
+        payoffKey = tuple(map(tuple, payoffs))
+        score = 0
+        for opponent, count in pool:
+            score += count*self.gameScore(payoffs, payoffKey, opponent, modelPlayer, numRounds)
+        score += self.gameScore(payoffs, payoffKey, None, modelPlayer, numRounds)
+        if metrics.enabled:
+            metrics.FITNESS_EVALUATIONS.inc(labels=("per_game",))
+        return score/(sum(count for _, count in pool)+1)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hitRate": self.hits/lookups if lookups else 0.0,
+                "size": len(self.scores), "capacity": self.scores.capacity}
+
+    def __reduce__(self):
+        return (GameCache, (self.scores.capacity,))
+
+class Budget:
+    #a wall-clock and/or fitness-evaluation limit for one training run
+    #trainers claim evaluations with take() and hand back the best model so far once it returns 0;
+    #stats() then says how much was used and why the run stopped
+    def __init__(self, seconds=None, maxEvaluations=None):
+        self.started = time.monotonic()
+        self.deadline = self.started + seconds if seconds is not None else None
+        self.maxEvaluations = maxEvaluations
+        self.evaluations = 0
+        self.stopReason = None
+
+    def exhausted(self):
+        if self.stopReason is None:
+            if self.maxEvaluations is not None and self.evaluations >= self.maxEvaluations:
+                self.stopReason = "evaluations"
+            elif self.deadline is not None and time.monotonic() >= self.deadline:
+                self.stopReason = "deadline"
+        return self.stopReason is not None
+
+    def take(self, n=1, minimum=0):
+        #claims up to n evaluations and returns how many were granted; minimum is granted even past the limit
+        granted = 0
+        if not self.exhausted():
+            granted = n if self.maxEvaluations is None else min(n, self.maxEvaluations - self.evaluations)
+        granted = max(granted, minimum)
+        self.evaluations += granted
+        return granted
+
+    def split(self, parts):
+        #equal slices of the evaluations left, one per restart, all with the same deadline
+        #fixed slices keep a seeded run's result the same however many processes share the restarts
+        shares = []
+        left = None if self.maxEvaluations is None else max(self.maxEvaluations - self.evaluations, 0)
+        for i in range(parts):
+            share = copy.copy(self)
+            share.evaluations = 0
+            if left is not None:
+                share.maxEvaluations = left//parts + (1 if i < left % parts else 0)
+            shares.append(share)
+        return shares
+
+    def absorb(self, share):
+        self.evaluations += share.evaluations
+        if self.stopReason is None:
+            self.stopReason = share.stopReason
+
+    def stats(self):
+        return {"evaluations": self.evaluations, "seconds": time.monotonic() - self.started,
+                "stopReason": self.stopReason or "completed"}
+
+def populationFitness(payoffs, models, population, memSize, cache=None, numRounds=20):
+    #calculateFitness for a whole list of genomes, played as one NumPy batch when the pool allows it
+    #duplicates and cached genomes are only scored once; a noisy fitness compares the whole list side by side
+    if getattr(cache, "compare", None) is not None:
+        return cache.compare(payoffs, models, population, memSize, numRounds)
+    pool = cache.poolKey(payoffs, models, memSize, numRounds) if cache is not None else None
+    scores = {}
+    missing = []
+    for genome in population:
+        if genome in scores:
+            continue
+        scores[genome] = cache.get((genome,) + pool) if pool is not None else None
+        if scores[genome] is None:
+            missing.append(genome)
+    if missing:
+        if all(isVectorizable(m, memSize) for m, _ in opponentCounts(models)):
+            fitnesses = evaluatePopulation(payoffs, models, missing, memSize, numRounds).tolist()
+        else:
+            fitnesses = [calculateFitness(payoffs, models, myModels[memSize](genome), numRounds) for genome in missing]
+        for genome, fitness in zip(missing, fitnesses):
+            scores[genome] = fitness
+            if pool is not None:
+                cache.put((genome,) + pool, fitness)
+    return [scores[genome] for genome in population]
+
+def successor(model, memSize, rng=random):
+    #rng is the random module or a seeded trainer's own random.Random
+    model = model ^ (1 << rng.randint(0, memSize-1))
     return model
 
-#First we'll use hill-climbing; should be easier to implement
-def train_hill_climb(numRestarts: int, numIterations: int, successor, payoffs, memSize):
-    models = [Defector(), Cooperator(), GrimTrigger(), TitForTat(), TwoTitForTat(), NiceTitForTat(), SuspiciousTitForTat()]
+def _rng(seed):
+    #a seeded run draws from its own random.Random, never reseeding the global generator other requests share
+    return random.Random(seed) if seed is not None else random
+
+def _restartSeeds(rng, numRestarts, workers):
+    #one seed per restart, so a restart plays out the same whichever process runs it
+    #unseeded single-process runs keep drawing from the global random stream like before
+    if rng is random and workers <= 1:
+        return [None]*numRestarts
+    return [rng.getrandbits(64) for _ in range(numRestarts)]
+
+def _startModel(initialModels, i, memSize, rng=random):
+    #restart i starts from the i-th warm-start model if there is one, otherwise from a random genome
+    if initialModels is not None and i < len(initialModels):
+        return initialModels[i] & ((1 << memSize) - 1)
+    return rng.getrandbits(memSize)
+
+def _runRestart(restart, i, seed, budget):
+    return (restart(i, seed, budget), budget)
 
-    bestModels = []
+def _runRestarts(restart, seeds, workers, budget):
+    #yields restart(index, seed, budget share) for every seed in restart order, running them on a process pool
+    #when workers > 1; serial restarts only run as they're asked for, so callers see each result before the next starts
+    shares = budget.split(len(seeds))
+    if workers <= 1:
+        for i, seed in enumerate(seeds):
+            result = restart(i, seed, shares[i])
+            budget.absorb(shares[i])
+            yield result
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for result, share in pool.map(_runRestart, repeat(restart), range(len(seeds)), seeds, shares):
+            budget.absorb(share)
+            yield result
+
+def _scoreCandidates(payoffs, models, memSize, parent, cache, candidates):
+    #worker side of a parallel neighbourhood scan
+    neighbors = NeighborFitness(payoffs, models, myModels[memSize](parent), cache=cache)
+    return neighbors.fitnesses(candidates)
+
+def _hill_climb_restart(numIterations, payoffs, memSize, cache, initialModels, restart, seed, budget):
+    #only the first restart scores its starting model once the budget is gone, so there's always a result
+    rng = _rng(seed)
+    if not budget.take(1, minimum=1 if restart == 0 else 0):
+        return None
+    fitness = cache if cache is not None else calculateFitness
+    models = [Defector(), Cooperator(), GrimTrigger(), TitForTat(), TwoTitForTat(), NiceTitForTat(), SuspiciousTitForTat()]
     ModelPlayer = myModels[memSize]
     numSuccessorsGenerated = memSize
-    for _ in range(numRestarts): #number of random restarts. After 10 iterations we just return the best model so far
-        curModel = random.getrandbits(memSize)
+    curModel = _startModel(initialModels, restart, memSize, rng)
+    curFitness = fitness(payoffs, models, ModelPlayer(curModel))
+    
+    #print(_)
+    for _ in range(numIterations):
+        if metrics.enabled:
+            metrics.TRAINER_ITERATIONS.inc(labels=("hill_climb",))
+        neighbors = NeighborFitness(payoffs, models, ModelPlayer(curModel), cache=cache)
         
-        #print(_)
-        for _ in range(numIterations):
-            successors = [(curModel, calculateFitness(payoffs, models, ModelPlayer(curModel)))]
+        candidates = [curModel ^ (1 << _) for _ in range(budget.take(memSize))]
+        scored = list(zip(candidates, neighbors.fitnesses(candidates)))
+        #the same as curFitness, unless a noisy fitness just estimated it again next to the candidates
+        successors = [(curModel, neighbors.parentFitness)] + scored
+        if budget.exhausted():
+            #a neighbour scored before the budget ran out may beat the current model
+            curModel, curFitness = max(successors, key=lambda x: x[1])
+            break
             
-            for _ in range(memSize):
-                model = curModel ^ (1 << _)
-                modelPlayer = ModelPlayer(model)
-
-                fitness = calculateFitness(payoffs=payoffs, models=models, modelPlayer=modelPlayer)
-                successors.append((model, fitness))
-            
-                
-            # print(successors)
-            
-            successors.sort(reverse=True, key=lambda x: x[1])
-            nextModels = [successors[i][0] for i in range(numSuccessorsGenerated)]
-            nextWeights = [(successors[i][1]-successors[-1][1])**2 for i in range(numSuccessorsGenerated)]
+        # print(successors)
         
+        successors.sort(reverse=True, key=lambda x: x[1])
+        nextWeights = [(s[1]-successors[-1][1])**2 for s in successors[:numSuccessorsGenerated]]
+    
 
 
-            curModel = random.choices(nextModels, nextWeights)[0] if sum(nextWeights) != 0 else successors[0]
-            # print(curModel)
-            
-        # print(bestModels)
-        bestModels.append((curModel, calculateFitness(payoffs, models, ModelPlayer(curModel))))
+        curModel, curFitness = rng.choices(successors[:numSuccessorsGenerated], nextWeights)[0] if sum(nextWeights) != 0 else successors[0]
+        # print(curModel)
+        
+    return (curModel, curFitness)
+
+#First we'll use hill-climbing; should be easier to implement
+#workers > 1 runs the restarts in parallel processes; with a seed the result doesn't depend on the number of workers
+#budget (a Budget) stops the search early with the best model so far
+#initialModels (genomes, e.g. from a GenomeStore) are where the first restarts start instead of random genomes
+def train_hill_climb(numRestarts: int, numIterations: int, successor, payoffs, memSize, cache=fitnessCache, workers=1, seed=None, budget=None, initialModels=None):
+    #number of random restarts. After 10 iterations we just return the best model so far
+    budget = budget if budget is not None else Budget()
+    seeds = _restartSeeds(_rng(seed), numRestarts, workers)
+    restarts = _runRestarts(partial(_hill_climb_restart, numIterations, payoffs, memSize, cache, initialModels), seeds, workers, budget)
+    bestModels = [result for result in restarts if result is not None]
+    # print(bestModels)
     bestModels.sort(reverse=True, key=lambda x: x[1])
     return bestModels[0]
 
-def train_hill_climb_tabu_restart(numRestarts: int, numIterations: int, successor, payoffs, memSize, tabuSize):
+def _hill_climb_tabu_restart(numIterations, payoffs, memSize, tabuSize, cache, initialModels, restart, seed, budget):
+    rng = _rng(seed)
+    if not budget.take(1, minimum=1 if restart == 0 else 0):
+        return None
+    fitness = cache if cache is not None else calculateFitness
+    #this is just a training set, we can swap it out with other models
+    models = [Defector(), Cooperator(), GrimTrigger(), TitForTat(), TwoTitForTat(), NiceTitForTat(), SuspiciousTitForTat()]
+    # models = [Cooperator(), Cooperator(), Cooperator()]
+    ModelPlayer = myModels[memSize]
+    #the parent and its memSize neighbours are all there is to pick from when memSize is small
+    numSuccessorsGenerated = min(20, memSize + 1)
+    visitedStates = LRUCache(tabuSize)
+    curModel = _startModel(initialModels, restart, memSize, rng)
+    curFitness = fitness(payoffs, models, ModelPlayer(curModel))
+    visitedStates.put(curModel, curModel)
+    
+    for i in range(numIterations):
+        if metrics.enabled:
+            metrics.TRAINER_ITERATIONS.inc(labels=("hill_climb_tabu_restart",))
+
+        neighbors = NeighborFitness(payoffs, models, ModelPlayer(curModel), cache=cache)
+        
+        candidates = []
+        for _ in range(budget.take(memSize)):
+            model = curModel ^ (1 << _)
+            while model in visitedStates:
+                model = model ^ (1 << rng.randint(0, memSize-1))
+            candidates.append(model)
+
+        #only the top numSuccessorsGenerated and the least fit one are looked at, so the rest needn't be played out
+        scored = list(zip(candidates, scoreNeighborhood(neighbors, candidates, numSuccessorsGenerated)))
+        successors = [(curModel, neighbors.parentFitness)] + scored
+        if budget.exhausted():
+            #a neighbour scored before the budget ran out may beat the current model
+            curModel, curFitness = max(successors, key=lambda x: x[1])
+            break
+        
+        
+        successors.sort(reverse=True, key=lambda x: x[1])
+        nextWeights = [(s[1]-successors[-1][1])**2 for s in successors[:numSuccessorsGenerated]]
+
+        curModel, curFitness = rng.choices(successors[:numSuccessorsGenerated], nextWeights)[0] if sum(nextWeights) != 0 else successors[0]
+    
+    return (curModel, curFitness)
+
+def train_hill_climb_tabu_restart(numRestarts: int, numIterations: int, successor, payoffs, memSize, tabuSize, cache=fitnessCache, workers=1, seed=None, budget=None, initialModels=None):
     
     #we'll be storing a vector of past 3 game states, and if the other guy has defected AT ALL (even previous to those three states)
     #128 total states once you've made it to >= 3 rounds
@@ -142,154 +936,212 @@ def train_hill_climb_tabu_restart(numRestarts: int, numIterations: int, successo
     #and then only 1 state at first
     #so first 128 bits are just the regular states, next 16 = i == 2, next 4 = i == 1, next 1 = i == 0
     #128 + 16 + 4 + 1 = 149 total bits
-    
-    #this is just a training set, we can swap it out with other models
-    models = [Defector(), Cooperator(), GrimTrigger(), TitForTat(), TwoTitForTat(), NiceTitForTat(), SuspiciousTitForTat()]
-    # models = [Cooperator(), Cooperator(), Cooperator()]
-
-    bestModels = []
-    ModelPlayer = myModels[memSize]
-    numSuccessorsGenerated = 20
-    visitedStates = LRUCache(tabuSize)
-    for _ in range(numRestarts): #number of random restarts. After 10 iterations we just return the best model so far
-        curModel = random.getrandbits(memSize)
-        visitedStates.put(curModel, curModel)
-        
-        # print(_)
-        for i in range(numIterations):
-
-            successors = [(curModel, calculateFitness(payoffs, models, ModelPlayer(curModel)))]
-            
-            for _ in range(memSize):
-                model = curModel ^ (1 << _)
-                while model in visitedStates.keyToNode:
-                    model = model ^ (1 << random.randint(0, 148))
-                modelPlayer = ModelPlayer(model)
-
-                fitness = calculateFitness(payoffs=payoffs, models=models, modelPlayer=modelPlayer)
-                successors.append((model, fitness))
-            
-            
-            successors.sort(reverse=True, key=lambda x: x[1])
-            nextModels = [successors[i][0] for i in range(numSuccessorsGenerated)]
-            nextWeights = [(successors[i][1]-successors[-1][1])**2 for i in range(numSuccessorsGenerated)]
 
-            curModel = random.choices(nextModels, nextWeights)[0] if sum(nextWeights) != 0 else successors[0]
-        
-        bestModels.append((curModel, calculateFitness(payoffs, models, ModelPlayer(curModel))))
+    #each restart keeps its own tabu list so restarts can run in parallel (workers > 1)
+    #initialModels, if given, are where the first restarts start
+    budget = budget if budget is not None else Budget()
+    seeds = _restartSeeds(_rng(seed), numRestarts, workers)
+    restarts = _runRestarts(partial(_hill_climb_tabu_restart, numIterations, payoffs, memSize, tabuSize, cache, initialModels), seeds, workers, budget)
+    bestModels = [result for result in restarts if result is not None]
     bestModels.sort(reverse=True, key=lambda x: x[1])
     
     return bestModels[0]
 
-def train_hill_climb_tabu(numIterations: int, successor, payoffs, memSize, tabuSize):
+def train_hill_climb_tabu(numIterations: int, successor, payoffs, memSize, tabuSize, cache=fitnessCache, workers=1, seed=None, budget=None, initialModels=None):
     """
     Perform tabu hill climbing without random restarts, tracking the globally best model.
     
     Parameters:
         numIterations (int): Number of iterations to run the search.
-        successor (function): Function to generate a neighboring solution.
+        successor (function): Function to generate a neighboring solution, called as successor(model, memSize, rng).
         payoffs (list): Payoff matrix.
         memSize (int): Size of the bit-string representing a solution.
         tabuSize (int): Maximum size of the tabu list.
+        cache (FitnessCache): Memo for fitness scores, or None to always recompute.
+        workers (int): Processes to score each neighbourhood with.
+        seed (int): Seed for the search; the result is the same for any number of workers.
+        budget (Budget): Time/evaluation limit; the best model so far is returned once it runs out.
+        initialModels (list): Genomes to start from; the search starts at the first one instead of a random genome.
         
     Returns:
         (bestModel, bestFitness): The best solution found and its fitness.
     """
+    rng = _rng(seed)
+    budget = budget if budget is not None else Budget()
+    fitness = cache if cache is not None else calculateFitness
     # Define evaluation models.
     models = [Defector(), Cooperator(), GrimTrigger(), TitForTat(), 
               TwoTitForTat(), NiceTitForTat(), SuspiciousTitForTat()]
     ModelPlayer = myModels[memSize]
+    # Candidates are always drawn here, only their scoring is spread over the pool.
+    # A noisy fitness compares a whole neighbourhood side by side, so it isn't split up.
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 and getattr(cache, "compare", None) is None else None
     
     # Initialize tabu list and starting solution.
     visitedStates = LRUCache(tabuSize)
-    curModel = random.getrandbits(memSize)
+    curModel = _startModel(initialModels, 0, memSize, rng)
     visitedStates.put(curModel, curModel)
     
     # Track the best model seen so far.
+    budget.take(1, minimum=1)
     bestModel = curModel
-    bestFitness = calculateFitness(payoffs, models, ModelPlayer(curModel))
+    bestFitness = curFitness = fitness(payoffs, models, ModelPlayer(curModel))
     
     for _ in range(numIterations):
-        # Evaluate the current solution and its successors.
-        successors_list = [(curModel, calculateFitness(payoffs, models, ModelPlayer(curModel)))]
-        
-        for _ in range(2 * memSize):
-            candidate = successor(curModel, memSize)
+        # Stop once the budget can't pay for any more candidates.
+        numCandidates = budget.take(2 * memSize)
+        if numCandidates == 0:
+            break
+        if metrics.enabled:
+            metrics.TRAINER_ITERATIONS.inc(labels=("hill_climb_tabu",))
+        candidates = []
+        for _ in range(numCandidates):
+            candidate = successor(curModel, memSize, rng)
             # Ensure candidate is not tabu.
-            while candidate in visitedStates.keyToNode:
-                candidate = successor(candidate, memSize)
-            candidateFitness = calculateFitness(payoffs, models, ModelPlayer(candidate))
-            successors_list.append((candidate, candidateFitness))
+            while candidate in visitedStates:
+                candidate = successor(candidate, memSize, rng)
+            candidates.append(candidate)
+
+        # Evaluate the current solution and its successors.
+        # Only games that read a bit the candidate changed are replayed, and only until the candidate
+        # provably misses the top memSize (see scoreNeighborhood).
+        if pool is None:
+            neighbors = NeighborFitness(payoffs, models, ModelPlayer(curModel), cache=cache)
+            candidateFitnesses = scoreNeighborhood(neighbors, candidates, memSize)
+            successors_list = [(curModel, neighbors.parentFitness)]
+        else:
+            successors_list = [(curModel, curFitness)]
+            chunks = [candidates[i::workers] for i in range(workers)]
+            scored = pool.map(partial(_scoreCandidates, payoffs, models, memSize, curModel, cache), chunks)
+            candidateFitnesses = [0]*len(candidates)
+            for i, chunkFitnesses in enumerate(scored):
+                candidateFitnesses[i::workers] = chunkFitnesses
+        successors_list += zip(candidates, candidateFitnesses)
+        # Update global best from every scored candidate, not just the one picked below
+        # (a pruned candidate is never the best, see scoreNeighborhood).
+        best = max(successors_list, key=lambda x: x[1])
+        if best[1] > bestFitness:
+            bestModel, bestFitness = best
         
         # Sort candidates by descending fitness.
         successors_list.sort(reverse=True, key=lambda x: x[1])
         # Choose the top memSize candidates and calculate weights.
-        nextModels = [s[0] for s in successors_list[:memSize]]
         nextWeights = [(s[1] - successors_list[-1][1])**2 for s in successors_list[:memSize]]
         
-        # Select the next current model probabilistically.
-        curModel = random.choices(nextModels, nextWeights)[0]
-        curFitness = calculateFitness(payoffs, models, ModelPlayer(curModel))
+        # Select the next current model probabilistically; its fitness is already known.
+        curModel, curFitness = rng.choices(successors_list[:memSize], nextWeights)[0] if sum(nextWeights) != 0 else successors_list[0]
         visitedStates.put(curModel, curModel)
-        # Update global best if needed.
-        if curFitness > bestFitness:
-            bestModel = curModel
-            bestFitness = curFitness
-            
+
+    if pool is not None:
+        pool.shutdown()
     return bestModel, bestFitness
 
 
-def train_simulated_annealing(numRestarts, temperature, successor, models, payoffs, memSize, coolingMul=.99):
+def _anneal_restart(temperature, successor, models, payoffs, memSize, coolingMul, cache, progress, initialModels, restart, seed, budget):
+    #one annealing run from a fresh random model (or a warm-start one); returns the best model it saw, its fitness and the final temperature
+    rng = _rng(seed)
+    if not budget.take(1):
+        return (None, float("-inf"), temperature)
+    fitness = cache if cache is not None else calculateFitness
+    compare = getattr(cache, "compare", None)
+    ModelPlayer = myModels[memSize]
+    best, bestFitness = None, float("-inf")
+    curModel = _startModel(initialModels, restart, memSize, rng)
+    curModelFitness = fitness(payoffs, models, ModelPlayer(curModel))
+    if initialModels is not None and restart < len(initialModels):
+        #a hot start wanders off its warm model straight away, so keep it in case nothing better turns up
+        best, bestFitness = curModel, curModelFitness
+    t = temperature
+    while t > .1 and budget.take(1):
+        
+        nextModel = successor(curModel, memSize, rng)
+        if compare is not None:
+            #a noisy fitness estimates both side by side, on as many replications as telling them apart takes
+            curModelFitness, nextModelFitness = compare(payoffs, models, [curModel, nextModel], memSize)
+        else:
+            nextModelFitness = fitness(payoffs, models, ModelPlayer(nextModel))
+
+        if nextModelFitness > bestFitness:
+            best = nextModel 
+            bestFitness = nextModelFitness
+        if nextModelFitness >= curModelFitness:
+            curModel, curModelFitness = nextModel, nextModelFitness
+        else:
+            probChoose = e**((nextModelFitness-curModelFitness)/t)
+            curModel, curModelFitness = rng.choices([(curModel, curModelFitness), (nextModel, nextModelFitness)], [1-probChoose, probChoose])[0]
+        if metrics.enabled:
+            metrics.TRAINER_ITERATIONS.inc(labels=("simulated_annealing",))
+            metrics.ANNEALING_MOVES.inc(labels=("accepted" if curModel == nextModel else "rejected",))
+            #4 possibilities for the first move: CC, CD, DC, DD
+            #1st move can have 4 possibilities, 2nd move can have 4 possibilities 4 x 4 = 16
+        t *= coolingMul
+        if progress is not None:
+            progress(restart, t, bestFitness)
+    return (best, bestFitness, t)
+
+def train_simulated_annealing(numRestarts, temperature, successor, models, payoffs, memSize, coolingMul=.99, cache=fitnessCache, progress=None, workers=1, seed=None, budget=None, initialModels=None):
     #generate a successor state. If better take it, otherwise don't
-    curModel = random.getrandbits(memSize)
+    #progress, if given, is called as progress(restart, temperature, bestFitness) after every cooling step
+    #(after every finished restart when workers > 1, since the restarts then run in other processes)
+    #with a seed the result doesn't depend on the number of workers
+    #budget (a Budget) stops the search early with the best model so far
+    #initialModels (genomes, e.g. from a GenomeStore) are where the first restarts start instead of random genomes
+    models = opponentCounts(models)
+    budget = budget if budget is not None else Budget()
+    fitness = cache if cache is not None else calculateFitness
+    rng = _rng(seed)
+    seeds = _restartSeeds(rng, numRestarts, workers)
+    curModel = rng.getrandbits(memSize)
 
     bestGlobal = curModel 
     ModelPlayer = myModels[memSize]
-    bestGlobalFitness = calculateFitness(payoffs, models, ModelPlayer(curModel))
-    for _ in range(numRestarts):
-        curModel = random.getrandbits(memSize)
-        t = temperature
-        while t > .1:
-            
-            nextModel = successor(curModel, memSize)
-            curModelFitness = calculateFitness(payoffs, models, ModelPlayer(curModel))
-            nextModelFitness = calculateFitness(payoffs, models, ModelPlayer(nextModel))
-
-            if nextModelFitness > bestGlobalFitness:
-                bestGlobal = nextModel 
-                bestGlobalFitness = nextModelFitness
-            if nextModelFitness >= curModelFitness:
-                curModel = nextModel 
-            else:
-                probChoose = e**((nextModelFitness-curModelFitness)/t)
-                curModel = random.choices([curModel, nextModel], [1-probChoose, probChoose])[0]
-                #4 possibilities for the first move: CC, CD, DC, DD
-                #1st move can have 4 possibilities, 2nd move can have 4 possibilities 4 x 4 = 16
-            t *= coolingMul
+    budget.take(1, minimum=1)
+    bestGlobalFitness = fitness(payoffs, models, ModelPlayer(curModel))
+
+    def restartProgress(restart, t, bestFitness):
+        progress(restart, t, max(bestFitness, bestGlobalFitness))
+
+    #serial restarts run one at a time as they're iterated, so each reports progress against the restarts before it
+    serialProgress = restartProgress if progress is not None and workers <= 1 else None
+    runs = _runRestarts(partial(_anneal_restart, temperature, successor, models, payoffs, memSize, coolingMul, cache, serialProgress, initialModels), seeds, workers, budget)
+    for i, (best, bestFitness, t) in enumerate(runs):
+        if bestFitness > bestGlobalFitness:
+            bestGlobal = best
+            bestGlobalFitness = bestFitness
+        if progress is not None and workers > 1:
+            progress(i, t, bestGlobalFitness)
 
-    return (bestGlobal, calculateFitness(payoffs, models, ModelPlayer(bestGlobal)))
+    return (bestGlobal, fitness(payoffs, models, ModelPlayer(bestGlobal)))
 
 
 # function for training a model that plays the prisoners dilemma based on the basic genetic algorithm seen in class notes
 # requires: initial population size of the algorithm, number of iterations for creating a new generation, amount of parents we
 # want for the next generation to be created(percentForCrossover), payoffs are the scores for each action based on column row formatting
 # models will be the basic models we created
-def train_basic_genetic(initialPopulationSize, numIterations, percentForCrossover, models, payoffs, memSize):
-    #randomly generated population
-    population = [random.getrandbits(memSize) for _ in range(initialPopulationSize)]
+def train_basic_genetic(initialPopulationSize, numIterations, percentForCrossover, models, payoffs, memSize, cache=fitnessCache, budget=None, initialModels=None):
+    models = opponentCounts(models)
+    budget = budget if budget is not None else Budget()
+    #randomly generated population, apart from any warm-start models (initialModels)
+    population = [_startModel(initialModels, i, memSize) for i in range(initialPopulationSize)]
     bestGlobal = None
     #calculate the # of successors we are going to be generating
     sizeForChoosing = max(ceil(initialPopulationSize*percentForCrossover), 2)
-    ModelPlayer = myModels[memSize]
 
     for _ in range(numIterations):
-        #calculate fitness for all generated models
-        fitnessForAll = [(population[i], calculateFitness(payoffs, models, ModelPlayer(population[i]))) for i in range(len(population))]
+        #calculate fitness for all generated models (or as many as the budget still allows)
+        population = population[:budget.take(len(population), minimum=1 if bestGlobal is None else 0)]
+        if not population:
+            break
+        if metrics.enabled:
+            metrics.TRAINER_ITERATIONS.inc(labels=("basic_genetic",))
+        fitnessForAll = list(zip(population, populationFitness(payoffs, models, population, memSize, cache)))
         #sort based on the best fitnesses
         fitnessForAll.sort(reverse=True, key=lambda x: x[1])
 
         #update best model ever seen 
         bestGlobal = bestGlobal if bestGlobal is not None and bestGlobal[1] > fitnessForAll[0][1] else fitnessForAll[0]
+        if budget.exhausted():
+            break
 
         #choose top percent of the models
         topPercentFitness = fitnessForAll[:sizeForChoosing]
@@ -315,60 +1167,218 @@ def train_basic_genetic(initialPopulationSize, numIterations, percentForCrossove
 
 # function for training a model that plays the prisoners dilemma based on the basic genetic algorithm seen in class notes
 # will try a random mutation with mutationCount number of times
-def train_basic_genetic_mutation(initialPopulationSize, numIterations, percentForCrossover, mutationPercent, mutationCount, models, payoffs, memSize):
-    #randomly generated population
-    population = [random.getrandbits(memSize) for _ in range(initialPopulationSize)]
+def train_basic_genetic_mutation(initialPopulationSize, numIterations, percentForCrossover, mutationPercent, mutationCount, models, payoffs, memSize, cache=fitnessCache, budget=None, initialModels=None):
+    models = opponentCounts(models)
+    budget = budget if budget is not None else Budget()
+    #randomly generated population, apart from any warm-start models (initialModels)
+    population = [_startModel(initialModels, i, memSize) for i in range(initialPopulationSize)]
     bestGlobal = None
     #calculate the # of successors we are going to be generating
     sizeForChoosing = max(ceil(initialPopulationSize*percentForCrossover), 2)
-    ModelPlayer = myModels[memSize]
 
     for _ in range(numIterations):
-        #calculate fitness for all generated models
-        fitnessForAll = [(population[i], calculateFitness(payoffs, models, ModelPlayer(population[i]))) for i in range(len(population))]
+        #calculate fitness for all generated models (or as many as the budget still allows)
+        population = population[:budget.take(len(population), minimum=1 if bestGlobal is None else 0)]
+        if not population:
+            break
+        if metrics.enabled:
+            metrics.TRAINER_ITERATIONS.inc(labels=("basic_genetic_mutation",))
+        fitnessForAll = list(zip(population, populationFitness(payoffs, models, population, memSize, cache)))
         #sort based on the best fitnesses
         fitnessForAll.sort(reverse=True, key=lambda x: x[1])
 
         #update best model ever seen 
         bestGlobal = bestGlobal if bestGlobal is not None and bestGlobal[1] > fitnessForAll[0][1] else fitnessForAll[0]
+        if budget.exhausted():
+            break
 
-        #choose top percent of the models
-        topPercentFitness = fitnessForAll[:sizeForChoosing]
-        
-        #Calculate probability of those models being chosen
-        sumOfTopPercent = sum(child[1] for child in topPercentFitness)
-        probabilityForTopPercent = [child[1]/sumOfTopPercent for child in topPercentFitness]
+        population = _breed(random, fitnessForAll, initialPopulationSize, sizeForChoosing, mutationPercent, mutationCount, memSize)
+    
+    return bestGlobal
 
-        #generate a new population based on a random crossover point and 2 chosen parents 
-        newPopulation = []
-        for _ in range(initialPopulationSize):
-            parents = random.choices(topPercentFitness, weights=probabilityForTopPercent, k=2)
-            crossoverPoint = random.choices([i for i in range(1, memSize-1)], k=1)[0]
-            newParent = ((parents[0][0] >> crossoverPoint) << crossoverPoint) + (parents[1][0] & (2**(crossoverPoint) - 1))
+def _breed(rng, fitnessForAll, populationSize, sizeForChoosing, mutationPercent, mutationCount, memSize):
+    #the next generation from a population sorted by fitness; rng is the random module or a random.Random
+    #choose top percent of the models
+    topPercentFitness = fitnessForAll[:sizeForChoosing]
+    
+    #Calculate probability of those models being chosen
+    sumOfTopPercent = sum(child[1] for child in topPercentFitness)
+    probabilityForTopPercent = [child[1]/sumOfTopPercent for child in topPercentFitness]
 
-            #mutates mutationCount number of times
-            for _ in range(mutationCount):
-                willMutate = random.choices([True, False], [mutationPercent, 1-mutationPercent])[0]
+    #generate a new population based on a random crossover point and 2 chosen parents 
+    newPopulation = []
+    for _ in range(populationSize):
+        parents = rng.choices(topPercentFitness, weights=probabilityForTopPercent, k=2)
+        crossoverPoint = rng.choices([i for i in range(1, memSize-1)], k=1)[0]
+        newParent = ((parents[0][0] >> crossoverPoint) << crossoverPoint) + (parents[1][0] & (2**(crossoverPoint) - 1))
 
-                if(willMutate):
-                    mutationPoint = random.choices([i for i in range(0, memSize)], k=1)[0]
-                    newParent = newParent ^ (1 << mutationPoint)
+        #mutates mutationCount number of times
+        for _ in range(mutationCount):
+            willMutate = rng.choices([True, False], [mutationPercent, 1-mutationPercent])[0]
 
-            newPopulation.append(newParent)
+            if(willMutate):
+                mutationPoint = rng.choices([i for i in range(0, memSize)], k=1)[0]
+                newParent = newParent ^ (1 << mutationPoint)
 
-        population = newPopulation
-    
+        newPopulation.append(newParent)
+    return newPopulation
+
+class _Island:
+    #one sub-population of train_island_genetic, with its own random generator and share of the budget
+    def __init__(self, seed, populationSize, percentForCrossover, mutationPercent, mutationCount, models, payoffs, memSize, cache, budget, initialModels):
+        self.rng = random.Random(seed)
+        self.populationSize = populationSize
+        self.sizeForChoosing = max(ceil(populationSize*percentForCrossover), 2)
+        self.mutationPercent = mutationPercent
+        self.mutationCount = mutationCount
+        self.models = models
+        self.payoffs = payoffs
+        self.memSize = memSize
+        self.cache = cache
+        self.budget = budget
+        warm = [model & ((1 << memSize) - 1) for model in initialModels[:populationSize]]
+        self.population = warm + [self.rng.getrandbits(memSize) for _ in range(populationSize - len(warm))]
+        self.scored = None
+        self.best = None
+
+    def evaluate(self):
+        #scores the current generation; False once the budget has nothing left for it
+        population = self.population[:self.budget.take(len(self.population), minimum=1 if self.best is None else 0)]
+        if not population:
+            return False
+        if metrics.enabled:
+            metrics.TRAINER_ITERATIONS.inc(labels=("island_genetic",))
+        self.scored = list(zip(population, populationFitness(self.payoffs, self.models, population, self.memSize, self.cache)))
+        self.scored.sort(reverse=True, key=lambda x: x[1])
+        if self.best is None or self.scored[0][1] > self.best[1]:
+            self.best = self.scored[0]
+        return True
+
+    def emigrants(self, count):
+        return self.scored[:count]
+
+    def immigrate(self, migrants):
+        #migrants take the places of the weakest models; they bring their fitness along, so nothing is rescored
+        self.scored = self.scored[:len(self.scored) - len(migrants)] + migrants
+        self.scored.sort(reverse=True, key=lambda x: x[1])
+        if self.scored[0][1] > self.best[1]:
+            self.best = self.scored[0]
+
+    def breed(self):
+        self.population = _breed(self.rng, self.scored, self.populationSize, self.sizeForChoosing, self.mutationPercent, self.mutationCount, self.memSize)
+
+def _islandSchedule(numIterations, migrationInterval, generation):
+    #whether islands swap migrants after this generation
+    return migrationInterval > 0 and (generation + 1) % migrationInterval == 0 and generation + 1 < numIterations
+
+ISLAND_POLL = 1 #seconds between checks that an island process is still alive while waiting on it
+
+def _runIslands(islands, numIterations, migrationInterval, migrants, inbox, outbox, parent):
+    #the body of one island process, hosting a run of consecutive islands: evolve, swap migrants around the ring
+    #(straight from island to island inside the process, over the pipes at either end of the run), and report every
+    #generation's bests
+    for generation in range(numIterations):
+        alive = [island.evaluate() for island in islands]
+        if _islandSchedule(numIterations, migrationInterval, generation):
+            outgoing = [island.emigrants(migrants) for island in islands]
+            outbox.send(outgoing[-1])
+            incoming = [inbox.recv()] + outgoing[:-1]
+            for island, arriving in zip(islands, incoming):
+                island.immigrate(arriving)
+        parent.send([island.best for island in islands])
+        for island, living in zip(islands, alive):
+            if living and generation + 1 < numIterations:
+                island.breed()
+    parent.send([island.budget for island in islands])
+
+def _receive(receiver, process):
+    #receiver.recv(), but an island process that died raises instead of leaving the parent waiting forever
+    try:
+        while not receiver.poll(ISLAND_POLL):
+            if not process.is_alive() and not receiver.poll():
+                raise EOFError
+        return receiver.recv()
+    except EOFError:
+        process.join(timeout=ISLAND_POLL)
+        raise RuntimeError(f"an island process exited with code {process.exitcode}") from None
+
+def train_island_genetic(numIslands, populationSize, numIterations, percentForCrossover, mutationPercent, mutationCount, models, payoffs, memSize,
+                         migrationInterval=5, migrants=2, cache=fitnessCache, progress=None, workers=1, seed=None, budget=None, initialModels=None):
+    #train_basic_genetic_mutation on numIslands populations of populationSize that evolve separately; every
+    #migrationInterval generations each island sends its best `migrants` models to the next island in a ring
+    #with workers > 1 the islands are split over that many processes (at most one per island), talking over pipes;
+    #the result is the same either way
+    #progress, if given, is called as progress(generation, islandBestFitnesses, globalBestFitness) every generation
+    models = opponentCounts(models)
+    budget = budget if budget is not None else Budget()
+    rng = _rng(seed)
+    seeds = [rng.getrandbits(64) for _ in range(numIslands)]
+    warm = list(initialModels or [])
+    shares = budget.split(numIslands)
+    islands = [_Island(seeds[i], populationSize, percentForCrossover, mutationPercent, mutationCount, models, payoffs, memSize, cache, shares[i], warm[i::numIslands])
+               for i in range(numIslands)]
+    bestGlobal = None
+
+    def report(generation, bests):
+        nonlocal bestGlobal
+        for best in bests:
+            if bestGlobal is None or best[1] > bestGlobal[1]:
+                bestGlobal = best
+        if progress is not None:
+            progress(generation, [best[1] for best in bests], bestGlobal[1])
+
+    if workers <= 1:
+        for generation in range(numIterations):
+            alive = [island.evaluate() for island in islands]
+            if _islandSchedule(numIterations, migrationInterval, generation):
+                outgoing = [island.emigrants(migrants) for island in islands]
+                for i, island in enumerate(islands):
+                    island.immigrate(outgoing[i-1])
+            report(generation, [island.best for island in islands])
+            for island, living in zip(islands, alive):
+                if living and generation + 1 < numIterations:
+                    island.breed()
+        for island in islands:
+            budget.absorb(island.budget)
+        return bestGlobal
+
+    #process p hosts a run of consecutive islands and sends its last island's migrants to process p+1 over ring[p]
+    numProcesses = min(workers, numIslands)
+    runs = [islands[p*numIslands//numProcesses:(p+1)*numIslands//numProcesses] for p in range(numProcesses)]
+    ring = [multiprocessing.Pipe(duplex=False) for _ in range(numProcesses)]
+    reports = [multiprocessing.Pipe(duplex=False) for _ in range(numProcesses)]
+    processes = [multiprocessing.Process(target=_runIslands, daemon=True,
+                                         args=(run, numIterations, migrationInterval, migrants, ring[p-1][0], ring[p][1], reports[p][1]))
+                 for p, run in enumerate(runs)]
+    for process in processes:
+        process.start()
+    #only the processes use the ring and the sending ends of the reports
+    for receiver, sender in ring:
+        receiver.close()
+        sender.close()
+    for _, sender in reports:
+        sender.close()
+    try:
+        for generation in range(numIterations):
+            report(generation, [best for (receiver, _), process in zip(reports, processes) for best in _receive(receiver, process)])
+        for (receiver, _), process in zip(reports, processes):
+            for share in _receive(receiver, process):
+                budget.absorb(share)
+    finally:
+        for process in processes:
+            process.join(timeout=1)
+            if process.is_alive():
+                process.terminate()
     return bestGlobal
 
-def local_beam_search(numIterations: int, k: int, successor, models, payoffs, memSize):
-    kBestModels = []
-    ModelPlayer = myModels[memSize]
+def local_beam_search(numIterations: int, k: int, successor, models, payoffs, memSize, cache=fitnessCache, budget=None, initialModels=None):
     
-    #generate k models to start search from 
-    for _ in range(k):
-        newModel = random.getrandbits(memSize)
-        fitness = calculateFitness(payoffs=payoffs, models=models, modelPlayer=ModelPlayer(newModel))
-        kBestModels.append((newModel, fitness))
+    models = opponentCounts(models)
+    budget = budget if budget is not None else Budget()
+    #generate k models to start search from (warm-start models first, if any)
+    newModels = [_startModel(initialModels, i, memSize) for i in range(k)]
+    newModels = newModels[:budget.take(k, minimum=1)]
+    kBestModels = list(zip(newModels, populationFitness(payoffs, models, newModels, memSize, cache)))
 
     #take the best found
     kBestModels.sort(reverse=True, key=lambda x: x[1])
@@ -377,20 +1387,23 @@ def local_beam_search(numIterations: int, k: int, successor, models, payoffs, me
 
     #number of times of expansion of the k best models
     for _ in range(numIterations):
-        successors = []
+        candidates = []
         for currModel in kBestModels:
             
             for i in range(memSize):
                 model = currModel[0] << i 
                 # model = successor(currModel[0], memSize)
 
-                modelPlayer = ModelPlayer(model)
-                
-                fitness = calculateFitness(payoffs=payoffs, models=models, modelPlayer=modelPlayer)
-                successors.append((model, fitness))
+                candidates.append(model)
+        candidates = candidates[:budget.take(len(candidates))]
+        if not candidates:
+            break
+        if metrics.enabled:
+            metrics.TRAINER_ITERATIONS.inc(labels=("local_beam_search",))
+        successors = list(zip(candidates, populationFitness(payoffs, models, candidates, memSize, cache)))
         
         successors.sort(reverse=True, key=lambda x: x[1])
-        kBestModels = [successors[i] for i in range(k)]
+        kBestModels = successors[:k]
         bestModelFound = bestModelFound if bestModelFound[1] >= kBestModels[0][1] else kBestModels[0]
     
     return bestModelFound
@@ -0,0 +1,71 @@
+#Trained genomes kept with the configuration they were trained for, so new requests can start from the closest ones
+#a configuration is what calculateFitness actually weighs: each opponent's share of the games (self-play included)
+#and the payoff matrix rescaled to 0..1, since shifting or scaling the payoffs doesn't change which genome is best
+import json
+import os
+import sqlite3
+import time
+from players import opponentCounts
+
+GENOME_STORE_DB = os.environ.get("GENOME_STORE_DB", "genomes.sqlite3")
+GENOME_STORE_SIZE = int(os.environ.get("GENOME_STORE_SIZE", "5000")) #configurations kept before the least recently used go
+WARM_START_MODELS = 3 #nearest genomes handed to a trainer; its other restarts still start at random
+
+def configuration(models, payoffs):
+    #(opponent weights, rescaled payoffs, (offset, scale)); fitness*scale + offset is the fitness on the 0..1 payoffs
+    pool = opponentCounts(models)
+    numPlayers = sum(count for _, count in pool)+1
+    weights = {"self": 1/numPlayers}
+    for opponent, count in pool:
+        name = type(opponent).__name__
+        if getattr(opponent, "model", None) is not None:
+            name += f":{opponent.model:x}"
+        weights[name] = weights.get(name, 0) + count/numPlayers
+    flat = [float(p) for row in payoffs for p in row]
+    low, high = min(flat), max(flat)
+    scale = 1/(high - low) if high > low else 0.0
+    return weights, [(p - low)*scale for p in flat], (-low*scale, scale)
+
+def distance(config1, config2):
+    weights1, payoffs1 = config1
+    weights2, payoffs2 = config2
+    return sum(abs(weights1.get(name, 0) - weights2.get(name, 0)) for name in weights1.keys() | weights2.keys()) \
+        + sum(abs(p1 - p2) for p1, p2 in zip(payoffs1, payoffs2))
+
+class GenomeStore:
+    def __init__(self, path: str, capacity: int):
+        self.path = path
+        self.capacity = capacity
+        with self.connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""CREATE TABLE IF NOT EXISTS genomes (
+                memSize INTEGER NOT NULL,
+                config TEXT NOT NULL,
+                model TEXT NOT NULL,
+                fitness REAL NOT NULL,
+                used REAL NOT NULL,
+                PRIMARY KEY (memSize, config))""")
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def add(self, models, payoffs, memSize, model, fitness):
+        #keeps the fittest genome seen for each configuration
+        weights, flat, (offset, scale) = configuration(models, payoffs)
+        key = json.dumps([{name: round(w, 12) for name, w in sorted(weights.items())}, [round(p, 12) for p in flat]])
+        with self.connect() as db:
+            db.execute("""INSERT INTO genomes (memSize, config, model, fitness, used) VALUES (?, ?, ?, ?, ?)
+                          ON CONFLICT(memSize, config) DO UPDATE SET used = excluded.used,
+                          model = CASE WHEN excluded.fitness > fitness THEN excluded.model ELSE model END,
+                          fitness = MAX(fitness, excluded.fitness)""",
+                       (memSize, key, hex(model), fitness*scale + offset, time.time()))
+            db.execute("DELETE FROM genomes WHERE rowid IN (SELECT rowid FROM genomes ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                       (self.capacity,))
+
+    def nearest(self, models, payoffs, memSize, k=WARM_START_MODELS):
+        #the genomes of the k closest stored configurations, closest first (fitter first on ties)
+        weights, flat, _ = configuration(models, payoffs)
+        with self.connect() as db:
+            rows = db.execute("SELECT config, model, fitness FROM genomes WHERE memSize = ?", (memSize,)).fetchall()
+        scored = sorted((distance((weights, flat), json.loads(config)), -fitness, int(model, 16)) for config, model, fitness in rows)
+        return [model for _, _, model in scored[:k]]
@@ -0,0 +1,233 @@
+#Background training jobs for the API: submit returns an id right away, training runs in a worker process,
+#and status/progress/results live in a small SQLite file so every gunicorn worker sees the same jobs
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from game import Budget, train_simulated_annealing, successor
+from players import poolFromCounts
+from genomes import GenomeStore, GENOME_STORE_DB, GENOME_STORE_SIZE
+
+JOBS_DB = os.environ.get("JOBS_DB", "jobs.sqlite3")
+TRAINING_WORKERS = int(os.environ.get("TRAINING_WORKERS", "2")) #training processes per HTTP worker
+MAX_QUEUED_JOBS = int(os.environ.get("MAX_QUEUED_JOBS", "32")) #queued + running jobs before submit refuses more
+JOB_RETENTION = 24*60*60 #seconds a finished job is kept around for
+PROGRESS_INTERVAL = .25 #seconds between progress writes (and cancellation checks) while training
+JOB_HEARTBEAT = float(os.environ.get("JOB_HEARTBEAT", "10")) #seconds between the owning worker's touches of its unfinished jobs
+JOB_TIMEOUT = float(os.environ.get("JOB_TIMEOUT", "120")) #unfinished jobs untouched for this long are marked failed
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+class JobCancelled(Exception):
+    pass
+
+class QueueFull(Exception):
+    pass
+
+class JobStore:
+    def __init__(self, path: str):
+        self.path = path
+        with self.connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                params TEXT NOT NULL,
+                progress TEXT,
+                result TEXT,
+                error TEXT,
+                cancel INTEGER NOT NULL DEFAULT 0,
+                created REAL NOT NULL,
+                updated REAL NOT NULL)""")
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def create(self, params):
+        jobId = uuid.uuid4().hex
+        now = time.time()
+        with self.connect() as db:
+            db.execute("INSERT INTO jobs (id, status, params, created, updated) VALUES (?, ?, ?, ?, ?)",
+                       (jobId, QUEUED, json.dumps(params), now, now))
+        return jobId
+
+    def get(self, jobId):
+        with self.connect() as db:
+            row = db.execute("SELECT id, status, params, progress, result, error, cancel, created, updated FROM jobs WHERE id = ?",
+                             (jobId,)).fetchone()
+        if row is None:
+            return None
+        return {
+            "id": row[0],
+            "status": row[1],
+            "params": json.loads(row[2]),
+            "progress": json.loads(row[3]) if row[3] else None,
+            "result": json.loads(row[4]) if row[4] else None,
+            "error": row[5],
+            "cancelRequested": bool(row[6]),
+            "created": row[7],
+            "updated": row[8],
+        }
+
+    def update(self, jobId, **fields):
+        for name in ("progress", "result"):
+            if name in fields:
+                fields[name] = json.dumps(fields[name])
+        fields["updated"] = time.time()
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self.connect() as db:
+            db.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), jobId))
+
+    def cancelRequested(self, jobId):
+        with self.connect() as db:
+            row = db.execute("SELECT cancel FROM jobs WHERE id = ?", (jobId,)).fetchone()
+        return row is None or bool(row[0])
+
+    def requestCancel(self, jobId):
+        #queued jobs are cancelled straight away, running ones stop at their next progress check
+        with self.connect() as db:
+            db.execute("UPDATE jobs SET cancel = 1, updated = ? WHERE id = ? AND status IN (?, ?)",
+                       (time.time(), jobId, QUEUED, RUNNING))
+            db.execute("UPDATE jobs SET status = ?, updated = ? WHERE id = ? AND status = ?",
+                       (CANCELLED, time.time(), jobId, QUEUED))
+
+    def active(self):
+        with self.connect() as db:
+            return db.execute("SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)", (QUEUED, RUNNING)).fetchone()[0]
+
+    def touch(self, jobIds):
+        #heartbeat: the worker that owns these jobs is still alive
+        if not jobIds:
+            return
+        with self.connect() as db:
+            db.execute(f"UPDATE jobs SET updated = ? WHERE id IN ({', '.join('?'*len(jobIds))}) AND status IN (?, ?)",
+                       (time.time(), *jobIds, QUEUED, RUNNING))
+
+    def fail(self, jobId, error):
+        #marks a job failed unless it already finished
+        with self.connect() as db:
+            db.execute("UPDATE jobs SET status = ?, error = ?, updated = ? WHERE id = ? AND status IN (?, ?)",
+                       (FAILED, error, time.time(), jobId, QUEUED, RUNNING))
+
+    def reap(self, olderThan):
+        #unfinished jobs whose worker stopped sending heartbeats (it crashed or was restarted) will never finish
+        with self.connect() as db:
+            db.execute("UPDATE jobs SET status = ?, error = ?, updated = ? WHERE status IN (?, ?) AND updated < ?",
+                       (FAILED, "the worker running this job went away", time.time(), QUEUED, RUNNING, olderThan))
+
+    def purge(self, olderThan):
+        with self.connect() as db:
+            db.execute("DELETE FROM jobs WHERE status NOT IN (?, ?) AND updated < ?", (QUEUED, RUNNING, olderThan))
+
+def runJob(path, jobId):
+    #runs inside a worker process
+    store = JobStore(path)
+    if store.cancelRequested(jobId):
+        store.update(jobId, status=CANCELLED)
+        return
+    params = store.get(jobId)["params"]
+    numRestarts = params.get("numRestarts", 5)
+    budget = None
+    if params.get("budget"):
+        budget = Budget(seconds=params["budget"].get("seconds"), maxEvaluations=params["budget"].get("maxEvaluations"))
+    lastReport = [0.0]
+
+    def progress(restart, temperature, bestFitness):
+        now = time.time()
+        if now - lastReport[0] < PROGRESS_INTERVAL:
+            return
+        lastReport[0] = now
+        if store.cancelRequested(jobId):
+            raise JobCancelled()
+        store.update(jobId, progress={"restart": restart, "numRestarts": numRestarts,
+                                      "temperature": temperature, "bestFitness": bestFitness})
+
+    store.update(jobId, status=RUNNING, progress={"restart": 0, "numRestarts": numRestarts})
+    models = poolFromCounts(params["players"])
+    genomes = GenomeStore(GENOME_STORE_DB, GENOME_STORE_SIZE)
+    try:
+        initialModels = genomes.nearest(models, params["payoffs"], 149) if params.get("warmStart", True) else None
+        model, fitness = train_simulated_annealing(numRestarts=numRestarts, temperature=100, successor=successor,
+                                                   models=models, payoffs=params["payoffs"], memSize=149,
+                                                   progress=progress, budget=budget, initialModels=initialModels)
+        genomes.add(models, params["payoffs"], 149, model, fitness)
+    except JobCancelled:
+        store.update(jobId, status=CANCELLED)
+    except Exception as error:
+        store.update(jobId, status=FAILED, error=repr(error))
+    else:
+        result = {"model": bin(model)[2:], "fitness": fitness}
+        if budget is not None:
+            result["stats"] = budget.stats()
+        store.update(jobId, status=DONE, result=result)
+
+class JobRunner:
+    #the process pool is only started on first submit, so each gunicorn worker gets its own after forking
+    #a thread touches every job this worker still owns each JOB_HEARTBEAT seconds, so jobs left behind by a worker
+    #that died are reaped after JOB_TIMEOUT; jobs whose process died or raised are marked failed when their future ends
+    def __init__(self, store: JobStore, maxWorkers: int, maxQueued: int):
+        self.store = store
+        self.maxWorkers = maxWorkers
+        self.maxQueued = maxQueued
+        self.pool = None
+        self.pending = {} #future: jobId for every job submitted here that hasn't finished
+        self.lock = threading.Lock()
+        self.heartbeat = None
+
+    def reap(self):
+        self.store.reap(time.time() - JOB_TIMEOUT)
+
+    def submit(self, params):
+        self.store.purge(time.time() - JOB_RETENTION)
+        self.reap()
+        if self.store.active() >= self.maxQueued:
+            raise QueueFull()
+        jobId = self.store.create(params)
+        if self.heartbeat is None:
+            self.heartbeat = threading.Thread(target=self.beat, daemon=True)
+            self.heartbeat.start()
+        try:
+            future = self.start().submit(runJob, self.store.path, jobId)
+        except BrokenProcessPool:
+            #a worker process died and took the pool with it; later jobs get a fresh one
+            self.pool = None
+            future = self.start().submit(runJob, self.store.path, jobId)
+        with self.lock:
+            self.pending[future] = jobId
+        future.add_done_callback(self.finished)
+        return jobId
+
+    def start(self):
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.maxWorkers)
+        return self.pool
+
+    def finished(self, future):
+        #runJob records its own outcome; this only catches what escaped it (a dead process, a database error)
+        with self.lock:
+            jobId = self.pending.pop(future)
+        error = future.exception() if not future.cancelled() else "cancelled before it started"
+        if error is not None:
+            try:
+                self.store.fail(jobId, repr(error) if isinstance(error, BaseException) else error)
+            except sqlite3.Error:
+                pass #the heartbeat stops with the future, so the job is reaped later instead
+
+    def beat(self):
+        while True:
+            time.sleep(JOB_HEARTBEAT)
+            with self.lock:
+                jobIds = list(self.pending.values())
+            try:
+                self.store.touch(jobIds)
+            except sqlite3.Error:
+                pass
@@ -0,0 +1,159 @@
+#Counters and timers for the game engine and the trainers, exported in the Prometheus text format by app.py
+#every call site checks `metrics.enabled` first, so with METRICS=0 the hot paths only pay for that one check
+#numbers are per process: restarts run on a process pool (workers > 1) and background jobs aren't counted here
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+enabled = os.environ.get("METRICS", "1") != "0"
+PREFIX = "cooperaition_"
+
+class _Local(threading.local):
+    timings = None #the dict collecting this thread's breakdown, while inside timings()
+
+_local = _Local()
+_lock = threading.Lock() #one lock for every metric, so a game's counters are updated in one go
+registry = []
+
+def _addTiming(timings, key, amount):
+    timings[key] = timings.get(key, 0) + amount
+
+class Counter:
+    def __init__(self, name: str, help: str, labelNames=()):
+        self.name = name
+        self.help = help
+        self.labelNames = labelNames
+        self.values = {}
+        registry.append(self)
+
+    def inc(self, amount=1, labels=()):
+        with _lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+        if _local.timings is not None:
+            _addTiming(_local.timings, ".".join((self.name,) + labels), amount)
+
+    def samples(self):
+        with _lock:
+            return [(PREFIX + self.name + "_total", labels, value) for labels, value in self.values.items()]
+
+class Gauge:
+    def __init__(self, name: str, help: str, labelNames=()):
+        self.name = name
+        self.help = help
+        self.labelNames = labelNames
+        self.values = {}
+        registry.append(self)
+
+    def set(self, value, labels=()):
+        with _lock:
+            self.values[labels] = value
+
+    def samples(self):
+        with _lock:
+            return [(PREFIX + self.name, labels, value) for labels, value in self.values.items()]
+
+class Histogram:
+    BUCKETS = (.00001, .00005, .0001, .0005, .001, .005, .01, .05, .1, .5, 1, 5, 10, 30, 60)
+
+    def __init__(self, name: str, help: str, labelNames=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelNames = labelNames
+        self.buckets = buckets
+        self.values = {} #labels -> [bucket counts..., count, sum]
+        registry.append(self)
+
+    def observe(self, value, labels=()):
+        with _lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [0]*(len(self.buckets)+2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-2] += 1
+            counts[-1] += value
+        if _local.timings is not None:
+            entry = _local.timings.setdefault(".".join((self.name,) + labels), {"count": 0, "seconds": 0.0})
+            entry["count"] += 1
+            entry["seconds"] += value
+
+    def samples(self):
+        name = PREFIX + self.name
+        out = []
+        with _lock:
+            for labels, counts in self.values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    out.append((name + "_bucket", labels + (("le", repr(float(bound))),), cumulative))
+                out.append((name + "_bucket", labels + (("le", "+Inf"),), counts[-2]))
+                out.append((name + "_count", labels, counts[-2]))
+                out.append((name + "_sum", labels, counts[-1]))
+        return out
+
+GAMES = Counter("games", "Games played, by engine", ("engine",))
+ROUNDS = Counter("rounds_simulated", "Rounds actually simulated (cycle extrapolation skips the rest), by engine", ("engine",))
+FITNESS_EVALUATIONS = Counter("fitness_evaluations", "Fitness evaluations, by method", ("method",))
+FITNESS_SECONDS = Histogram("calculate_fitness_seconds", "calculateFitness latency")
+CACHE_REQUESTS = Counter("fitness_cache_requests", "FitnessCache lookups, by result", ("result",))
+TRAINER_ITERATIONS = Counter("trainer_iterations", "Search iterations (cooling steps, generations, ...), by trainer", ("trainer",))
+ANNEALING_MOVES = Counter("annealing_moves", "Simulated annealing proposals, by outcome", ("outcome",))
+REQUEST_SECONDS = Histogram("request_seconds", "HTTP request latency, by endpoint", ("endpoint",))
+RESULT_CACHE_REQUESTS = Counter("result_cache_requests", "/get_model result cache lookups, by result", ("result",))
+ADMISSION_DECISIONS = Counter("admission_decisions", "Training requests by the profile they were admitted on, or why they were turned away", ("decision",))
+TRAINING_QUEUE = Gauge("training_queue", "Training requests running or waiting for a slot in this worker", ("state",))
+
+def gamePlayed(engine: str, rounds: int, games=1):
+    #GAMES and ROUNDS together, since this is the hottest call site
+    labels = (engine,)
+    with _lock:
+        GAMES.values[labels] = GAMES.values.get(labels, 0) + games
+        ROUNDS.values[labels] = ROUNDS.values.get(labels, 0) + rounds
+    if _local.timings is not None:
+        _addTiming(_local.timings, "games." + engine, games)
+        _addTiming(_local.timings, "rounds_simulated." + engine, rounds)
+
+def _formatLabels(labelNames, labels):
+    #labels is a tuple of values, or for histogram buckets values followed by ("le", bound)
+    pairs = []
+    for i, value in enumerate(labels):
+        if isinstance(value, tuple):
+            pairs.append(value)
+        else:
+            pairs.append((labelNames[i], value))
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{str(value)}"' for name, value in pairs) + "}"
+
+def exposition():
+    #all metrics in the Prometheus text format (version 0.0.4)
+    lines = []
+    for metric in registry:
+        if isinstance(metric, Counter):
+            family, kind = PREFIX + metric.name + "_total", "counter"
+        elif isinstance(metric, Gauge):
+            family, kind = PREFIX + metric.name, "gauge"
+        else:
+            family, kind = PREFIX + metric.name, "histogram"
+        lines.append(f"# HELP {family} {metric.help}")
+        lines.append(f"# TYPE {family} {kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{_formatLabels(metric.labelNames, labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+@contextmanager
+def timings():
+    #collects what the current thread does while inside the block into a dict, for a per-request breakdown
+    #counters add up under "name.label", histograms under the same key as {"count", "seconds"}
+    breakdown = {}
+    previous = _local.timings
+    _local.timings = breakdown
+    start = time.perf_counter()
+    try:
+        yield breakdown
+    finally:
+        breakdown["seconds"] = time.perf_counter() - start
+        _local.timings = previous
@@ -0,0 +1,125 @@
+#Monte Carlo fitness for pools with random players (RandomChooser) and for noisy play (every move trembles into the
+#other one with some probability), where a single game is only one sample of a random score
+#every game is played for many replications at once in a NumPy batch (playGameStochastic), and replication r is played
+#on the same random numbers for every genome, so two genomes are compared on the same luck (common random numbers)
+#and their difference needs far fewer replications than either fitness on its own
+import numpy as np
+from game import calculateFitness, populationFitness
+from players import RandomChooser, isDeterministic, modelLayout, opponentCounts
+from vectorized import isVectorizable, packGenomes, playGameBatch, playGameStochastic, _side
+
+Z = 1.96 #confidence intervals are 95%
+
+def fitnessSamples(payoffs, models, genomes, memSize, replications, numRounds=20, noise=0.0, seed=0):
+    #calculateFitness for every genome in each replication, as a (G, replications) array; seed is an int or a tuple
+    #of ints, and the same seed plays the same replications for any list of genomes
+    pool = opponentCounts(models)
+    for opponent, _ in pool:
+        if type(opponent) is not RandomChooser and not isVectorizable(opponent, memSize):
+            raise ValueError(f"{type(opponent).__name__} can't be played in a batch")
+    seeds = list(seed) if isinstance(seed, tuple) else [seed]
+    packed = packGenomes(genomes, memSize)
+    layout = modelLayout(memSize)
+    rows = np.repeat(np.arange(len(genomes)), replications)
+    replication = np.tile(np.arange(replications), len(genomes))
+    population = _side(None, packed, layout)
+    expanded = _side(None, packed[rows], layout)
+    samples = np.zeros((len(genomes), replications))
+    games = [(opponent, count, numRounds) for opponent, count in pool] + [(None, 1, numRounds//2)]
+    for k, (opponent, count, rounds) in enumerate(games):
+        rng = np.random.default_rng(seeds + [k])
+        if opponent is None:
+            #self-play
+            if noise:
+                score = playGameStochastic(payoffs, expanded, expanded, rounds, len(rows), replication, rng, noise)[0]
+            else:
+                score = np.repeat(playGameBatch(payoffs, population, population, rounds, len(genomes))[0], replications)
+        elif isDeterministic(opponent) and not noise:
+            #the same game in every replication
+            score = np.repeat(playGameBatch(payoffs, _side(opponent, packed, layout), population, rounds, len(genomes))[1], replications)
+        else:
+            side = None if type(opponent) is RandomChooser else _side(opponent, packed[rows], layout)
+            score = playGameStochastic(payoffs, side, expanded, rounds, len(rows), replication, rng, noise)[1]
+        samples += count*score.reshape(len(genomes), replications)
+    return samples/(sum(count for _, count in pool)+1)
+
+def meanInterval(samples):
+    #(mean, half width of its confidence interval) along the last axis
+    samples = np.asarray(samples, dtype=np.float64)
+    n = samples.shape[-1]
+    if n < 2:
+        return samples.mean(axis=-1), np.full(samples.shape[:-1], np.inf)
+    return samples.mean(axis=-1), Z*samples.std(axis=-1, ddof=1)/np.sqrt(n)
+
+def compareGenomes(payoffs, models, genomes, memSize, numRounds=20, noise=0.0, seed=0, tolerance=.01,
+                   minReplications=16, maxReplications=4096):
+    #(means, halfWidths, replications): each genome's mean fitness, its confidence interval and how many replications
+    #it took; a genome stops getting replications once its gap to the current leader is significant either way or
+    #narrower than tolerance, while the leader and every genome still close to it get twice as many (a lone genome
+    #gets them until its own interval is narrower than tolerance)
+    #batch b is always played on seed (seed, b), so any two genomes' replications pair up one to one
+    sizes = [minReplications]
+    batches = [[row] for row in fitnessSamples(payoffs, models, genomes, memSize, minReplications, numRounds, noise, (seed, 0))]
+    while True:
+        samples = [np.concatenate(rows) for rows in batches]
+        best = int(np.argmax([row.mean() for row in samples]))
+        active = [best]
+        for g, row in enumerate(samples):
+            if g != best:
+                common = min(len(row), len(samples[best]))
+                gap, halfWidth = meanInterval(samples[best][:common] - row[:common])
+                if abs(gap) <= halfWidth and halfWidth >= tolerance:
+                    active.append(g)
+        total = sum(sizes)
+        settled = meanInterval(samples[0])[1] < tolerance if len(genomes) == 1 else len(active) == 1
+        if settled or total >= maxReplications:
+            break
+        sizes.append(min(total, maxReplications - total))
+        #a genome that sat out earlier batches (say, a new leader) catches up on them first
+        for b, size in enumerate(sizes):
+            behind = [g for g in active if len(batches[g]) == b]
+            if behind:
+                rows = fitnessSamples(payoffs, models, [genomes[g] for g in behind], memSize, size, numRounds, noise, (seed, b))
+                for g, row in zip(behind, rows):
+                    batches[g].append(row)
+    results = [meanInterval(row) for row in samples]
+    return (np.array([mean for mean, _ in results]), np.array([halfWidth for _, halfWidth in results]),
+            np.array([len(row) for row in samples]))
+
+class StochasticFitness:
+    #a noisy stand-in for calculateFitness, for pools with random players or noisy play, passed to a trainer as its
+    #cache; trainers see its compare method and hand it every set of genomes they weigh against each other (a
+    #neighbourhood with its parent, a population, annealing's current and next model), which compareGenomes
+    #estimates side by side on common random numbers with as many replications as that comparison needs
+    #calling it scores one genome on its own, to within tolerance; without noise or random players it's exact
+    #key/poolKey return None like GameCache's, so trainers don't store a pool's fitness
+    def __init__(self, noise=0.0, seed=0, tolerance=.01, minReplications=16, maxReplications=4096):
+        self.noise = noise
+        self.seed = seed
+        self.tolerance = tolerance
+        self.minReplications = minReplications
+        self.maxReplications = maxReplications
+
+    def key(self, payoffs, models, modelPlayer, numRounds=20):
+        return None
+
+    def poolKey(self, payoffs, models, memSize, numRounds=20):
+        return None
+
+    def exact(self, models):
+        return not self.noise and all(isDeterministic(opponent) for opponent, _ in opponentCounts(models))
+
+    def compare(self, payoffs, models, genomes, memSize, numRounds=20):
+        #estimated fitness for each of genomes, as a list
+        if not genomes:
+            return []
+        if self.exact(models):
+            return populationFitness(payoffs, models, genomes, memSize, None, numRounds)
+        means, _, _ = compareGenomes(payoffs, models, genomes, memSize, numRounds, self.noise, self.seed, self.tolerance,
+                                     self.minReplications, self.maxReplications)
+        return means.tolist()
+
+    def __call__(self, payoffs, models, modelPlayer, numRounds=20):
+        if self.exact(models):
+            return calculateFitness(payoffs, models, modelPlayer, numRounds)
+        return self.compare(payoffs, models, [modelPlayer.model], modelPlayer.memSize, numRounds)[0]
@@ -7,6 +7,19 @@ class Player:
     def get_action(self, past_moves, i):
         return 0 
 
+    #Compact protocol: instead of reading the move history, a player can carry an explicit state that is
+    #updated in O(1) per round. A state is (key, counter): key is hashable, counter is None or an int
+    #that only affects play through counter > 0. initial_state() returning None means the player
+    #doesn't support it (e.g. it isn't deterministic), so games against it replay the history instead.
+    def initial_state(self):
+        return None
+
+    def next_move(self, state):
+        return 0
+
+    def next_state(self, state, myMove, oppMove):
+        return state
+
 class Defector(Player):
     def __init__(self):
         super().__init__()
@@ -15,6 +28,12 @@ class Defector(Player):
     def get_action(self, past_moves, i):
         return 1 
 
+    def initial_state(self):
+        return (0, None)
+
+    def next_move(self, state):
+        return 1
+
 class Cooperator(Player):
     def __init__(self):
         super().__init__()
@@ -22,6 +41,9 @@ class Cooperator(Player):
     
     def get_action(self, past_moves, i):
         return 0
+
+    def initial_state(self):
+        return (0, None)
     
 class GrimTrigger(Player):
     def __init__(self):
@@ -31,6 +53,16 @@ class GrimTrigger(Player):
     def get_action(self, past_moves, i):
         return 1 if 1 in past_moves[1] else 0
 
+    #state: whether the opponent has ever defected
+    def initial_state(self):
+        return (0, None)
+
+    def next_move(self, state):
+        return state[0]
+
+    def next_state(self, state, myMove, oppMove):
+        return (state[0] | oppMove, None)
+
 class RandomChooser(Player):
     def __init__(self):
         super().__init__()
@@ -49,6 +81,16 @@ class TitForTat(Player):
             return 0
         return past_moves[1][i-1]
 
+    #state: the opponent's last move, starting from a cooperation
+    def initial_state(self):
+        return (0, None)
+
+    def next_move(self, state):
+        return state[0]
+
+    def next_state(self, state, myMove, oppMove):
+        return (oppMove, None)
+
 class TwoTitForTat(Player):
     def __init__(self):
         super().__init__()
@@ -59,6 +101,16 @@ class TwoTitForTat(Player):
             return 0
         return 1 if (past_moves[1][i-1] == 1 and past_moves[1][i-2] == 1) else 0 
 
+    #state: the opponent's last two moves packed as (last<<1) + second to last
+    def initial_state(self):
+        return (0, None)
+
+    def next_move(self, state):
+        return 1 if state[0] == 3 else 0
+
+    def next_state(self, state, myMove, oppMove):
+        return ((oppMove << 1) | (state[0] >> 1), None)
+
 class NiceTitForTat(Player):
     def __init__(self):
         super().__init__()
@@ -68,6 +120,17 @@ class NiceTitForTat(Player):
         if i == 0 or past_moves[1].count(1) / i < .2:
             return 0 
         return 1
+
+    #state: (whether a round has been played, i - 5*opponent defections)
+    #count/i < .2 is the same test as i - 5*count > 0, and that counter drifts by a fixed amount per cycle
+    def initial_state(self):
+        return (0, 0)
+
+    def next_move(self, state):
+        return 0 if state[0] == 0 or state[1] > 0 else 1
+
+    def next_state(self, state, myMove, oppMove):
+        return (1, state[1] + 1 - 5*oppMove)
     
 class SuspiciousTitForTat(Player):
     def __init__(self):
@@ -79,81 +142,196 @@ class SuspiciousTitForTat(Player):
             return 1
         return past_moves[1][i-1]
 
-class ModelPlayer149(Player):
+    #state: the opponent's last move, starting from a defection
+    def initial_state(self):
+        return (1, None)
+
+    def next_move(self, state):
+        return state[0]
+
+    def next_state(self, state, myMove, oppMove):
+        return (oppMove, None)
+
+MAX_DEPTH = 6 #moves of history a model can remember; a depth 6 genome with the flag is already 9557 bits
+
+def modelSize(depth, flag):
+    #the genome bits for a model with depth moves of history each side (and the "opponent ever defected" bit with flag):
+    #one for every full history, plus the opening tables for rounds 0..depth-1
+    return (1 << (2*depth + flag)) + sum(4**i for i in range(depth))
+
+#memSize: (moves of history each side, whether the "opponent ever defected" bit is used), e.g. 21, 85 and 149
+MODEL_LAYOUTS = {modelSize(depth, flag): (depth, flag) for depth in range(1, MAX_DEPTH+1) for flag in (False, True)}
+
+def modelLayout(memSize):
+    #(depth, flag, offsets) where offsets[i] is where the opening table for round i < depth starts
+    #e.g. 149 = 128 full-history entries, then 16 for round 2, 4 for round 1 and 1 for round 0
+    if memSize not in MODEL_LAYOUTS:
+        raise ValueError(f"{memSize} isn't a model size; the sizes are {', '.join(map(str, sorted(MODEL_LAYOUTS)))}")
+    depth, flag = MODEL_LAYOUTS[memSize]
+    offsets = [0]*depth
+    offset = 1 << (2*depth + flag)
+    for i in range(depth-1, -1, -1):
+        offsets[i] = offset
+        offset += 4**i
+    return (depth, flag, offsets)
+
+def compileTransitions(memSize):
+    #table[bit][(myMove<<1) + oppMove] = the bit a model reads next round after reading bit this round
+    #the bit a model reads pins down every move it still remembers, so it works as the model's whole state
+    depth, flag, offsets = modelLayout(memSize)
+    def encode(i, mine, theirs, ever):
+        if i < depth:
+            return offsets[i] + (mine << i) + theirs
+        return (ever << (2*depth)) + (mine << depth) + theirs
+    table = [None]*memSize
+    for i in range(depth+1):
+        for mine in range(1 << i):
+            for theirs in range(1 << i):
+                for ever in ((0, 1) if flag and i == depth else (0,)):
+                    moves = []
+                    for myMove in (0, 1):
+                        for oppMove in (0, 1):
+                            if i < depth:
+                                nextTheirs = (oppMove << i) | theirs
+                                nextState = encode(i+1, (myMove << i) | mine, nextTheirs, int(flag and nextTheirs != 0))
+                            else:
+                                nextState = encode(depth, (myMove << (depth-1)) | (mine >> 1), (oppMove << (depth-1)) | (theirs >> 1), ever | (flag and oppMove))
+                            moves.append(nextState)
+                    table[encode(i, mine, theirs, ever)] = tuple(moves)
+    return table
+
+def embedModel(model, memSize, toMemSize):
+    #the toMemSize genome that plays exactly like a memSize one, e.g. a 21-bit model as 149 bits
+    #each entry of the longer table reads the shorter table with the oldest moves (and the flag) dropped
+    depth, flag, offsets = modelLayout(memSize)
+    toDepth, toFlag, toOffsets = modelLayout(toMemSize)
+    if depth > toDepth or (flag and not toFlag):
+        raise ValueError(f"a {memSize}-bit model remembers more than a {toMemSize}-bit one")
+    embedded = 0
+    for i in range(toDepth+1):
+        for mine in range(1 << i):
+            for theirs in range(1 << i):
+                for ever in ((0, 1) if toFlag and i == toDepth else (0,)):
+                    if i < toDepth:
+                        target = toOffsets[i] + (mine << i) + theirs
+                    else:
+                        target = (ever << (2*toDepth)) + (mine << toDepth) + theirs
+                    if i < depth:
+                        source = offsets[i] + (mine << i) + theirs
+                    else:
+                        source = ((mine >> (i-depth)) << depth) + (theirs >> (i-depth)) + ((ever << (2*depth)) if flag else 0)
+                    embedded |= ((model >> source) & 1) << target
+    return embedded
+
+class ModelPlayer(Player):
+    #a genome read as a lookup table from the moves both sides remember to the next move; the subclass's memSize
+    #picks the layout, and its transitions are compiled once when the class is made
+    memSize = None
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.depth, cls.flag, cls.offsets = modelLayout(cls.memSize)
+        cls.transitions = compileTransitions(cls.memSize)
+
     def __init__(self, model):
         super().__init__()
         self.name = "Sim Jim"
         self.model = model
-    def get_model_move(self, past_moves, i):
-        if i < 3:
-            if i == 0:
-                return (self.model >> 148) & 1
-            if i  == 1:
-                encoding = (past_moves[0][0]<<1) + (past_moves[1][0])
-                return ((self.model >> 144) >> encoding) & 1
-            if i == 2:
-                encoding = (past_moves[0][i-1]<<3) + (past_moves[0][i-2]<<2) + (past_moves[1][i-1]<<1) + (past_moves[1][i-2])
-                return ((self.model >> 128) >> encoding) & 1
-        else: #i >= 3
-            encoding = (int(1 in past_moves[1])<<6) + (past_moves[0][i-1]<<5) + (past_moves[0][i-2]<<4) + (past_moves[0][i-3]<<3) \
-                        + (past_moves[1][i-1]<<2) + (past_moves[1][i-2]<<1) + past_moves[1][i-3]
-            return (self.model >> encoding) & 1    
-        
-        
-    def get_action(self, past_moves, i):
-        return self.get_model_move(past_moves, i)
-    
+        self.reads = None #set to 0 to collect a bitmask of the genome bits this player looks up
 
-class ModelPlayer21(Player):
-    def __init__(self, model):
-        self.model = model
-    def get_model_move(self, past_moves, i):
-        if i < 2:
-            if i == 0:
-                return (self.model >> 20) & 1
-            if i  == 1:
-                # model[2* your move + opponent's move]
-                # {(): 1, (0, 0): 1, (0, 1): 0, (1, 1): 0, (1, 0, 0, 0, 1, 1, 1): 0}
-                encoding = (past_moves[0][0]<<1) + (past_moves[1][0])
-                return ((self.model >> 16) >> encoding) & 1
-        else:
-            encoding = (past_moves[0][i-1]<<3) + (past_moves[0][i-2]<<2) \
-                        + (past_moves[1][i-1]<<1) + (past_moves[1][i-2]<<0)
-            return (self.model >> encoding) & 1    
-        
-        
-    def get_action(self, past_moves, i):
-        return self.get_model_move(past_moves, i)
+    def __reduce__(self):
+        #classes made by myModels only exist once asked for, so pickle by memSize rather than by class
+        return (_modelPlayer, (self.memSize, self.model))
 
+    def get_model_bit(self, past_moves, i):
+        #the most recent move is the highest bit of each side's history
+        remembered = min(i, self.depth)
+        mine = 0
+        theirs = 0
+        for j in range(1, remembered+1):
+            mine = (mine << 1) + past_moves[0][i-j]
+            theirs = (theirs << 1) + past_moves[1][i-j]
+        if i < self.depth:
+            return self.offsets[i] + (mine << i) + theirs
+        ever = int(1 in past_moves[1][:i]) if self.flag else 0
+        return (ever << (2*self.depth)) + (mine << self.depth) + theirs
 
-class ModelPlayer85(Player):
-    def __init__(self, model):
-        self.model = model
     def get_model_move(self, past_moves, i):
-        if i < 3:
-            if i == 0:
-                return (self.model >> 84) & 1
-            if i  == 1:
-                encoding = (past_moves[0][0]<<1) + (past_moves[1][0])
-                return ((self.model >> 80) >> encoding) & 1
-            if i == 2:
-                encoding = (past_moves[0][i-1]<<3) + (past_moves[0][i-2]<<2) + (past_moves[1][i-1]<<1) + (past_moves[1][i-2])
-                return ((self.model >> 64) >> encoding) & 1
-        else:
-            encoding = (past_moves[0][i-1]<<5) + (past_moves[0][i-2]<<4) + (past_moves[0][i-3]<<3) \
-                        + (past_moves[1][i-1]<<2) + (past_moves[1][i-2]<<1) + past_moves[1][i-3]
-            return (self.model >> encoding) & 1    
-        
-        
+        bit = self.get_model_bit(past_moves, i)
+        if self.reads is not None:
+            self.reads |= 1 << bit
+        return (self.model >> bit) & 1
+
     def get_action(self, past_moves, i):
         return self.get_model_move(past_moves, i)
-    
 
-myModels = {
+    #state: the genome bit the next move is read from, which encodes the whole history the model looks at,
+    #so a move costs one table lookup however deep the history is
+    def initial_state(self):
+        return (self.memSize-1, None)
+
+    def next_move(self, state):
+        if self.reads is not None:
+            self.reads |= 1 << state[0]
+        return (self.model >> state[0]) & 1
+
+    def next_state(self, state, myMove, oppMove):
+        return (self.transitions[state[0]][(myMove<<1) + oppMove], None)
+
+class ModelPlayer21(ModelPlayer):
+    memSize = 21
+
+class ModelPlayer85(ModelPlayer):
+    memSize = 85
+
+class ModelPlayer149(ModelPlayer):
+    memSize = 149
+
+class _ModelClasses(dict):
+    #memSize -> its ModelPlayer class; the class for any other size in MODEL_LAYOUTS is made the first time it's asked for
+    def __missing__(self, memSize):
+        modelLayout(memSize)
+        return self.setdefault(memSize, type(f"ModelPlayer{memSize}", (ModelPlayer,), {"memSize": memSize, "__module__": __name__}))
+
+def _modelPlayer(memSize, model):
+    return myModels[memSize](model)
+
+myModels = _ModelClasses({
     21: ModelPlayer21,
     85: ModelPlayer85,
     149: ModelPlayer149
-}
+})
+
+#the strategies the frontend lets users pick, in the order /get_model lists them
+baseStrategies = [TitForTat, GrimTrigger, TwoTitForTat, NiceTitForTat, Cooperator, Defector, SuspiciousTitForTat]
+
+def poolFromCounts(counts):
+    #{"Tit For Tat": 3, ...} -> [(TitForTat(), 3), ...]; strategies that are left out count as 0
+    pool = []
+    for strategy in baseStrategies:
+        player = strategy()
+        pool.append((player, counts.get(player.name, 0)))
+    return pool
+
+def isDeterministic(player):
+    return player.initial_state() is not None
+
+def opponentCounts(models):
+    #the opponent pool as [(player, count)], with deterministic players that always play the same way merged
+    #accepts a list of players, a list of (player, count) pairs, or a mix of both
+    #random players keep one entry each since every one of them plays its own game
+    index = {}
+    pairs = []
+    for entry in models:
+        player, count = entry if isinstance(entry, tuple) else (entry, 1)
+        if count <= 0:
+            continue
+        key = (type(player), getattr(player, "model", None)) if isDeterministic(player) else id(player)
+        if key in index:
+            pairs[index[key]][1] += count
+        else:
+            index[key] = len(pairs)
+            pairs.append([player, count])
+    return [(player, count) for player, count in pairs]
 '''
 bit string in the form: (2^0bits)(2^2bits)(2^4bits)(2^7bits) =  since your first move and opponents is acting as a selector
 then we have 4 possibilites for you and 4 for opponent hence we have to select between 16
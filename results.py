@@ -0,0 +1,157 @@
+#Finished /get_model results, kept in a small SQLite file so they survive restarts and every gunicorn worker shares them
+#identical requests that arrive while one is still training wait for it instead of training again (single flight):
+#threads in the same worker wait on it directly, other workers see its lease row and poll for the result
+#python results.py --clear    drops every cached result
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+import metrics
+from players import poolFromCounts
+
+RESULT_CACHE_DB = os.environ.get("RESULT_CACHE_DB", "results.sqlite3")
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", "10000")) #results kept before the least recently used go
+TRAINING_VERSION = 1 #bump whenever a change to the trainers should stop old results being served
+LEASE = 300 #seconds before another worker gives up waiting on a training run and starts its own
+POLL_INTERVAL = .1
+
+def requestKey(mode, players, payoffs, budget=None, warmStart=True):
+    #the request boiled down to what changes the answer: strategy counts (zeros dropped), payoffs, mode, budget and
+    #whether training warm starts from stored genomes
+    counts = {player.name: count for player, count in poolFromCounts(players) if count > 0}
+    return json.dumps({"version": TRAINING_VERSION, "mode": mode, "players": counts,
+                       "payoffs": [[float(p) for p in row] for row in payoffs], "budget": budget,
+                       "warmStart": bool(warmStart)}, sort_keys=True)
+
+class ResultCache:
+    def __init__(self, path: str, capacity: int):
+        self.path = path
+        self.capacity = capacity
+        self.inflight = {} #key -> Future, for requests being trained by a thread in this worker
+        self.lock = threading.Lock()
+        with self.connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY,
+                version INTEGER NOT NULL,
+                result TEXT NOT NULL,
+                used REAL NOT NULL)""")
+            db.execute("CREATE INDEX IF NOT EXISTS results_used ON results (used)")
+            db.execute("CREATE TABLE IF NOT EXISTS leases (key TEXT PRIMARY KEY, started REAL NOT NULL)")
+            db.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            #results from older trainers are never asked for again
+            db.execute("DELETE FROM results WHERE version != ?", (TRAINING_VERSION,))
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, key):
+        with self.connect() as db:
+            row = db.execute("SELECT result FROM results WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                db.execute("UPDATE results SET used = ? WHERE key = ?", (time.time(), key))
+        return None if row is None else json.loads(row[0])
+
+    def put(self, key, result):
+        with self.connect() as db:
+            db.execute("INSERT OR REPLACE INTO results (key, version, result, used) VALUES (?, ?, ?, ?)",
+                       (key, TRAINING_VERSION, json.dumps(result), time.time()))
+            db.execute("DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                       (self.capacity,))
+
+    def count(self, name):
+        if metrics.enabled:
+            metrics.RESULT_CACHE_REQUESTS.inc(labels=(name,))
+        with self.connect() as db:
+            db.execute("INSERT INTO stats (name, value) VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET value = value + 1", (name,))
+
+    def stats(self):
+        #hits, misses and coalesced requests across every worker, plus how many results are stored
+        with self.connect() as db:
+            counts = dict(db.execute("SELECT name, value FROM stats").fetchall())
+            entries = db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        lookups = sum(counts.get(name, 0) for name in ("hit", "miss", "coalesced"))
+        return {"hits": counts.get("hit", 0), "misses": counts.get("miss", 0), "coalesced": counts.get("coalesced", 0),
+                "hitRate": (counts.get("hit", 0) + counts.get("coalesced", 0))/lookups if lookups else 0.0,
+                "entries": entries, "capacity": self.capacity, "version": TRAINING_VERSION}
+
+    def clear(self):
+        with self.connect() as db:
+            db.execute("DELETE FROM results")
+            db.execute("DELETE FROM stats")
+
+    def acquireLease(self, key):
+        #True if this worker should train; a lease older than LEASE belongs to a worker that died
+        now = time.time()
+        with self.connect() as db:
+            db.execute("DELETE FROM leases WHERE key = ? AND started < ?", (key, now - LEASE))
+            return db.execute("INSERT OR IGNORE INTO leases (key, started) VALUES (?, ?)", (key, now)).rowcount == 1
+
+    def releaseLease(self, key):
+        with self.connect() as db:
+            db.execute("DELETE FROM leases WHERE key = ?", (key,))
+
+    def leaseHeld(self, key):
+        with self.connect() as db:
+            row = db.execute("SELECT started FROM leases WHERE key = ?", (key,)).fetchone()
+        return row is not None and row[0] >= time.time() - LEASE
+
+    def getOrCompute(self, key, compute):
+        #returns (result, "hit" | "miss" | "coalesced"); compute() is only called when nobody else is on it
+        result = self.get(key)
+        if result is not None:
+            self.count("hit")
+            return result, "hit"
+        with self.lock:
+            future = self.inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self.inflight[key] = Future()
+        if not leader:
+            self.count("coalesced")
+            return future.result(), "coalesced"
+        try:
+            result, outcome = self.computeOnce(key, compute)
+            future.set_result(result)
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+        self.count(outcome)
+        return result, outcome
+
+    def computeOnce(self, key, compute):
+        #waits for another worker that holds the lease, or trains under our own
+        while not self.acquireLease(key):
+            while self.leaseHeld(key):
+                time.sleep(POLL_INTERVAL)
+            result = self.get(key)
+            if result is not None:
+                return result, "coalesced"
+        try:
+            #the last holder may have finished between our first lookup and taking the lease
+            result = self.get(key)
+            if result is not None:
+                return result, "hit"
+            result = compute()
+            #a result trained on a cheaper profile under load (see admission.py) isn't kept for later requests
+            if "profile" not in result:
+                self.put(key, result)
+        finally:
+            self.releaseLease(key)
+        return result, "miss"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or clear the /get_model result cache")
+    parser.add_argument("--clear", action="store_true", help="drop every cached result")
+    parser.add_argument("--path", default=RESULT_CACHE_DB)
+    args = parser.parse_args()
+    cache = ResultCache(args.path, RESULT_CACHE_SIZE)
+    if args.clear:
+        cache.clear()
+    print(json.dumps(cache.stats(), indent=2))
@@ -0,0 +1,159 @@
+#Exact best response: the genome with the highest calculateFitness against a fixed pool of deterministic opponents
+#a genome is a lookup table, so every game is a walk through the product of the model's state (the bit it reads next)
+#and the opponent's compact state. Branch and bound over the genome: play every game until one reads a bit that
+#hasn't been decided yet, then try both values. A branch is dropped once an optimistic bound on it can't beat the
+#best genome found so far; the bound replays each game as if every undecided bit could be chosen afresh on every visit
+from game import Budget, calculateFitness
+from players import myModels, isDeterministic, opponentCounts
+
+def _opponentBound(payoffs, opponent, transitions, assigned, values, i, state, bit, numRounds):
+    #most the model can still score from round i against this opponent, deciding undecided bits per visit
+    #also returns a mask of every bit the rest of the game could read, since only those can change the answer
+    layer = {(state, bit): 0}
+    reads = 0
+    for _ in range(i, numRounds):
+        nextLayer = {}
+        for (state, bit), score in layer.items():
+            reads |= 1 << bit
+            theirs = opponent.next_move(state)
+            for mine in ((values >> bit) & 1,) if (assigned >> bit) & 1 else (0, 1):
+                key = (opponent.next_state(state, theirs, mine), transitions[bit][(mine<<1) + theirs])
+                total = score + payoffs[mine][theirs]
+                if nextLayer.get(key, -1e300) < total:
+                    nextLayer[key] = total
+        layer = nextLayer
+    return max(layer.values()), reads
+
+def _selfBound(payoffs, transitions, assigned, values, i, bit1, bit2, numRounds):
+    #the same for self-play, where both sides read the one genome; two reads of the same bit in a round must agree
+    layer = {(bit1, bit2): 0}
+    reads = 0
+    for _ in range(i, numRounds):
+        nextLayer = {}
+        for (bit1, bit2), score in layer.items():
+            reads |= (1 << bit1) | (1 << bit2)
+            for move1 in ((values >> bit1) & 1,) if (assigned >> bit1) & 1 else (0, 1):
+                if bit2 == bit1:
+                    moves2 = (move1,)
+                else:
+                    moves2 = ((values >> bit2) & 1,) if (assigned >> bit2) & 1 else (0, 1)
+                for move2 in moves2:
+                    key = (transitions[bit1][(move1<<1) + move2], transitions[bit2][(move2<<1) + move1])
+                    total = score + payoffs[move1][move2]
+                    if nextLayer.get(key, -1e300) < total:
+                        nextLayer[key] = total
+        layer = nextLayer
+    return max(layer.values()), reads
+
+def _advanceOpponent(payoffs, opponent, transitions, assigned, values, game, numRounds):
+    #plays on until the model reads an undecided bit; returns the game and that bit (None once it's over)
+    i, state, bit, score = game
+    while i < numRounds:
+        if not (assigned >> bit) & 1:
+            return (i, state, bit, score), bit
+        mine = (values >> bit) & 1
+        theirs = opponent.next_move(state)
+        score += payoffs[mine][theirs]
+        state = opponent.next_state(state, theirs, mine)
+        bit = transitions[bit][(mine<<1) + theirs]
+        i += 1
+    return (i, state, bit, score), None
+
+def _advanceSelf(payoffs, transitions, assigned, values, game, numRounds):
+    i, bit1, bit2, score = game
+    while i < numRounds:
+        for bit in (bit1, bit2):
+            if not (assigned >> bit) & 1:
+                return (i, bit1, bit2, score), bit
+        move1 = (values >> bit1) & 1
+        move2 = (values >> bit2) & 1
+        score += payoffs[move1][move2]
+        bit1, bit2 = transitions[bit1][(move1<<1) + move2], transitions[bit2][(move2<<1) + move1]
+        i += 1
+    return (i, bit1, bit2, score), None
+
+def solveBestResponse(payoffs, models, memSize, numRounds=20, budget=None):
+    #returns (model, fitness, upperBound); fitness == upperBound means model is proven optimal
+    #a budget (one evaluation per search node) stops the search early, and upperBound then says how far off it might be
+    #bits no game ever reads don't change the fitness and are left at 0
+    pool = opponentCounts(models)
+    if not all(isDeterministic(opponent) for opponent, _ in pool):
+        raise ValueError("the exact solver needs deterministic opponents")
+    budget = budget if budget is not None else Budget()
+    transitions = myModels[memSize].transitions
+    selfRounds = numRounds//2
+    weights = [count/numRounds for _, count in pool] + [1/selfRounds]
+    numPlayers = sum(count for _, count in pool)+1
+    start = memSize-1
+
+    def advance(assigned, values, games):
+        #branches on the undecided bit the most games (weighted by count) are stuck on
+        advanced = []
+        waiting = {}
+        for (opponent, count), game in zip(pool, games):
+            game, bit = _advanceOpponent(payoffs, opponent, transitions, assigned, values, game, numRounds)
+            advanced.append(game)
+            if bit is not None:
+                waiting[bit] = waiting.get(bit, 0) + count
+        game, bit = _advanceSelf(payoffs, transitions, assigned, values, games[-1], selfRounds)
+        advanced.append(game)
+        if bit is not None:
+            waiting[bit] = waiting.get(bit, 0) + 1
+        return advanced, (max(waiting, key=waiting.get) if waiting else None)
+
+    #a game's bound only depends on the decided bits it can still reach, so it's cached on those;
+    #branching on one bit then only recomputes the games that could read it
+    reachable = {}
+    bounds = {}
+    def gameBound(k, game, assigned, values):
+        position = (k,) + game[:-1]
+        reads = reachable.get(position)
+        key = None if reads is None else (position, assigned & reads, values & reads)
+        if key is None or key not in bounds:
+            if k < len(pool):
+                rest, reads = _opponentBound(payoffs, pool[k][0], transitions, assigned, values, *game[:-1], numRounds)
+            else:
+                rest, reads = _selfBound(payoffs, transitions, assigned, values, *game[:-1], selfRounds)
+            reachable[position] = reads
+            key = (position, assigned & reads, values & reads)
+            bounds[key] = rest
+        return bounds[key]
+
+    def bound(assigned, values, games):
+        total = 0
+        for k, (weight, game) in enumerate(zip(weights, games)):
+            score = game[-1]
+            if game[0] < (numRounds if k < len(pool) else selfRounds):
+                score += gameBound(k, game, assigned, values)
+            total += weight*score
+        return total
+
+    games = [(0, opponent.initial_state(), start, 0) for opponent, _ in pool] + [(0, start, start, 0)]
+    stack = [(bound(0, 0, games), 0, 0, games)]
+    best, bestValue = 0, float("-inf")
+    while stack:
+        if not budget.take(1, minimum=1 if bestValue == float("-inf") else 0):
+            break
+        nodeBound, assigned, values, games = stack.pop()
+        if nodeBound <= bestValue:
+            continue
+        games, bit = advance(assigned, values, games)
+        if bit is None:
+            value = sum(weight*game[-1] for weight, game in zip(weights, games))
+            if value > bestValue:
+                best, bestValue = values, value
+            continue
+        children = []
+        for move in (0, 1):
+            childValues = values | (move << bit)
+            childBound = bound(assigned | (1 << bit), childValues, games)
+            if childBound > bestValue:
+                children.append((childBound, assigned | (1 << bit), childValues, games))
+        #depth first, most promising child on top
+        children.sort(key=lambda child: child[0])
+        stack += children
+
+    fitness = calculateFitness(payoffs, pool, myModels[memSize](best), numRounds)
+    if not stack:
+        return (best, fitness, fitness)
+    return (best, fitness, max(bestValue, max(child[0] for child in stack))/numPlayers)
@@ -0,0 +1,42 @@
+#Scores under many payoff matrices at once. Which moves get played never depends on the payoffs, so every game is
+#played once for its (CC, CD, DC, DD) outcome counts, and the scores under M payoff matrices are one (M, 4) matrix
+#product with those counts; sweeping thousands of matrices costs about as much as playing the games once
+import numpy as np
+from game import tournamentOutcomes
+from players import modelLayout, opponentCounts
+from vectorized import countOutcomesBatch, isVectorizable, packGenomes, _side
+
+def payoffVectors(payoffMatrices):
+    #(M, 4) array with each 2x2 payoff matrix as (CC, CD, DC, DD) from the first player's side
+    vectors = np.array(payoffMatrices, dtype=np.float64)
+    if vectors.ndim != 3 or vectors.shape[1:] != (2, 2):
+        raise ValueError("payoffs must be a list of 2x2 matrices")
+    return vectors.reshape(len(vectors), 4)
+
+def tournamentSweep(payoffMatrices, players, numRounds=100):
+    #tournamentMatrix under every payoff matrix: scores[m, i, j], as an (M, n, n) array; players must be deterministic
+    counts = tournamentOutcomes(players, numRounds)
+    return np.einsum("ijc,mc->mij", counts, payoffVectors(payoffMatrices))/numRounds
+
+def fitnessOutcomes(models, genomes, memSize, numRounds=20):
+    #(counts, weights): counts[g, k] is genome g's outcome counts in its k-th game (each distinct opponent, then
+    #self-play for numRounds//2 rounds) and weights[k] what one point scored in it adds to calculateFitness
+    pool = opponentCounts(models)
+    for opponent, _ in pool:
+        if not isVectorizable(opponent, memSize):
+            raise ValueError(f"{type(opponent).__name__} can't be played in a batch")
+    packed = genomes if isinstance(genomes, np.ndarray) else packGenomes(genomes, memSize)
+    layout = modelLayout(memSize)
+    population = _side(None, packed, layout)
+    counts = np.empty((len(packed), len(pool)+1, 4), dtype=np.int64)
+    for k, (opponent, _) in enumerate(pool):
+        counts[:, k] = countOutcomesBatch(population, _side(opponent, packed, layout), numRounds, len(packed))
+    counts[:, -1] = countOutcomesBatch(population, population, numRounds//2, len(packed))
+    numPlayers = sum(count for _, count in pool)+1
+    weights = np.array([count/numRounds for _, count in pool] + [1/(numRounds//2)])/numPlayers
+    return counts, weights
+
+def fitnessSweep(payoffMatrices, models, genomes, memSize, numRounds=20):
+    #calculateFitness for every genome under every payoff matrix, as an (M, G) array (the same up to rounding)
+    counts, weights = fitnessOutcomes(models, genomes, memSize, numRounds)
+    return payoffVectors(payoffMatrices) @ np.einsum("gkc,k->cg", counts, weights)
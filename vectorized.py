@@ -0,0 +1,199 @@
+#NumPy versions of the game engine that play a whole population of genomes at once
+#a population is a packed (P, W) uint64 array: bit b of a genome lives in word b//64 at position b%64
+import numpy as np
+import metrics
+from players import Player, Defector, Cooperator, GrimTrigger, TitForTat, TwoTitForTat, NiceTitForTat, SuspiciousTitForTat, myModels, modelLayout, opponentCounts, MAX_DEPTH
+
+WINDOW = MAX_DEPTH #moves of history kept per side, enough for every ModelPlayer
+GENOME = -1
+STRATEGY_CODES = {
+    Player: 0,
+    Cooperator: 0,
+    Defector: 1,
+    GrimTrigger: 2,
+    TitForTat: 3,
+    TwoTitForTat: 4,
+    NiceTitForTat: 5,
+    SuspiciousTitForTat: 6,
+}
+def packGenomes(genomes, memSize):
+    words = (memSize + 63)//64
+    mask = (1 << memSize) - 1
+    packed = np.zeros((len(genomes), words), dtype=np.uint64)
+    for w in range(words):
+        packed[:, w] = [((g & mask) >> (64*w)) & 0xFFFFFFFFFFFFFFFF for g in genomes]
+    return packed
+
+def unpackGenomes(packed):
+    return [sum(int(row[w]) << (64*w) for w in range(len(row))) for row in packed]
+
+def isVectorizable(player, memSize):
+    return type(player) in STRATEGY_CODES or type(player) is myModels.get(memSize)
+
+def _side(player, packed, layout):
+    #how one side of a batched game picks its moves: a fixed strategy code, or genome words looked up per row
+    if player is None:
+        return (GENOME, packed, np.arange(len(packed)), layout)
+    if type(player) in STRATEGY_CODES:
+        return (STRATEGY_CODES[type(player)], None, None, None)
+    return (GENOME, packGenomes([player.model], player.memSize), np.zeros(len(packed), dtype=np.int64), layout)
+
+def _moves(side, i, own, other, size):
+    code, words, rows, layout = side
+    otherWin, otherEver, otherCount = other
+    if code == GENOME:
+        depth, flag, offsets = layout
+        ownWin = own[0]
+        if i < depth:
+            index = offsets[i] + ((ownWin >> (WINDOW-i)) << i) + (otherWin >> (WINDOW-i))
+        else:
+            index = ((ownWin >> (WINDOW-depth)) << depth) + (otherWin >> (WINDOW-depth))
+            if flag:
+                index += otherEver << (2*depth)
+        return ((words[rows, index >> 6] >> (index & 63).astype(np.uint64)) & np.uint64(1)).astype(np.int64)
+    prev1 = (otherWin >> (WINDOW-1)) & 1
+    if code == 0:
+        return np.zeros(size, dtype=np.int64)
+    if code == 1:
+        return np.ones(size, dtype=np.int64)
+    if code == 2:
+        return otherEver
+    if code == 3:
+        return prev1
+    if code == 4:
+        return prev1 & (otherWin >> (WINDOW-2)) & 1
+    if code == 5:
+        return (5*otherCount >= i).astype(np.int64) if i > 0 else np.zeros(size, dtype=np.int64)
+    return prev1 if i > 0 else np.ones(size, dtype=np.int64)
+
+def _advance(state, moves):
+    window, ever, count = state
+    return ((window >> 1) | (moves << (WINDOW-1)), ever | moves, count + moves)
+
+def playGameBatch(payoffs, side1, side2, numRounds: int, size: int):
+    #playGame for `size` games in lockstep; returns the two per-game average score arrays
+    table = np.array(payoffs, dtype=np.float64)
+    state1 = (np.zeros(size, dtype=np.int64),)*3
+    state2 = (np.zeros(size, dtype=np.int64),)*3
+    score1 = np.zeros(size)
+    score2 = np.zeros(size)
+    if metrics.enabled:
+        metrics.gamePlayed("batch", size*numRounds, size)
+    for i in range(numRounds):
+        action1 = _moves(side1, i, state1, state2, size)
+        action2 = _moves(side2, i, state2, state1, size)
+        score1 += table[action1, action2]
+        score2 += table[action2, action1]
+        state1 = _advance(state1, action1)
+        state2 = _advance(state2, action2)
+    return (score1/numRounds, score2/numRounds)
+
+def playGameStochastic(payoffs, side1, side2, numRounds: int, size: int, replication, rng, noise=0.0):
+    #playGameBatch where a side can be a RandomChooser (None) and every move trembles into the other one with
+    #probability noise; game k is replication[k], and each round draws one set of random numbers per replication,
+    #so games in the same replication see the same luck whichever genomes are playing (common random numbers)
+    #the players remember the moves as played, trembles included
+    table = np.array(payoffs, dtype=np.float64)
+    numReplications = int(replication.max()) + 1 if size else 0
+    state1 = (np.zeros(size, dtype=np.int64),)*3
+    state2 = (np.zeros(size, dtype=np.int64),)*3
+    score1 = np.zeros(size)
+    score2 = np.zeros(size)
+    if metrics.enabled:
+        metrics.gamePlayed("stochastic", size*numRounds, size)
+    for i in range(numRounds):
+        draws = rng.random((4, numReplications))[:, replication]
+        action1 = (draws[0] < .5).astype(np.int64) if side1 is None else _moves(side1, i, state1, state2, size)
+        action2 = (draws[1] < .5).astype(np.int64) if side2 is None else _moves(side2, i, state2, state1, size)
+        if noise:
+            action1 = action1 ^ (draws[2] < noise)
+            action2 = action2 ^ (draws[3] < noise)
+        score1 += table[action1, action2]
+        score2 += table[action2, action1]
+        state1 = _advance(state1, action1)
+        state2 = _advance(state2, action2)
+    return (score1/numRounds, score2/numRounds)
+
+def countOutcomesBatch(side1, side2, numRounds: int, size: int):
+    #how often each pair of moves came up in each of `size` games, as a (size, 4) array of
+    #CC, CD, DC, DD counts from side1's point of view; the scores for any payoffs follow from these
+    counts = np.zeros((size, 4), dtype=np.int64)
+    rows = np.arange(size)
+    state1 = (np.zeros(size, dtype=np.int64),)*3
+    state2 = (np.zeros(size, dtype=np.int64),)*3
+    if metrics.enabled:
+        metrics.gamePlayed("batch", size*numRounds, size)
+    for i in range(numRounds):
+        action1 = _moves(side1, i, state1, state2, size)
+        action2 = _moves(side2, i, state2, state1, size)
+        counts[rows, (action1 << 1) | action2] += 1
+        state1 = _advance(state1, action1)
+        state2 = _advance(state2, action2)
+    return counts
+
+def evaluatePopulation(payoffs, models, genomes, memSize, numRounds=20):
+    #calculateFitness for every genome at once; genomes is a list of ints or an array from packGenomes
+    #every opponent must pass isVectorizable, and each distinct one is only played once
+    packed = genomes if isinstance(genomes, np.ndarray) else packGenomes(genomes, memSize)
+    size = len(packed)
+    layout = modelLayout(memSize)
+    if metrics.enabled:
+        metrics.FITNESS_EVALUATIONS.inc(size, ("batch",))
+    population = _side(None, packed, layout)
+    pool = opponentCounts(models)
+    total = np.zeros(size)
+    for opponent, count in pool:
+        if not isVectorizable(opponent, memSize):
+            raise ValueError(f"{type(opponent).__name__} can't be played in a batch")
+        total += count*playGameBatch(payoffs, _side(opponent, packed, layout), population, numRounds, size)[1]
+    total += playGameBatch(payoffs, population, population, numRounds//2, size)[0]
+    return total/(sum(count for _, count in pool)+1)
+
+PAIR_CHUNK = 1 << 15 #games played per batch in tournamentOutcomeBatch
+
+def _pairOutcomes(side1, rows1, side2, rows2, numRounds):
+    #countOutcomesBatch for the games rows1[k] vs rows2[k] of two genome populations, PAIR_CHUNK games at a time
+    code1, packed1, _, layout1 = side1
+    code2, packed2, _, layout2 = side2
+    counts = np.empty((len(rows1), 4), dtype=np.int64)
+    for start in range(0, len(rows1), PAIR_CHUNK):
+        stop = min(start + PAIR_CHUNK, len(rows1))
+        counts[start:stop] = countOutcomesBatch((code1, packed1, rows1[start:stop], layout1),
+                                                (code2, packed2, rows2[start:stop], layout2), numRounds, stop - start)
+    return counts
+
+def swapOutcomes(counts):
+    #outcome counts from the other player's side: CD and DC trade places
+    return counts[..., [0, 2, 1, 3]]
+
+def tournamentOutcomeBatch(players, numRounds=100):
+    #counts[i, j] = (CC, CD, DC, DD) in players[i]'s game against players[j], from players[i]'s side, for every pair
+    #involving a ModelPlayer, each unordered pair played once; pairs of other players are left as -1 for the caller
+    size = len(players)
+    counts = np.full((size, size, 4), -1, dtype=np.int64)
+    strategies = [i for i, player in enumerate(players) if type(player) in STRATEGY_CODES]
+    groups = {}
+    for i, player in enumerate(players):
+        if type(player) is myModels.get(getattr(player, "memSize", None)):
+            groups.setdefault(player.memSize, []).append(i)
+    sides = {memSize: _side(None, packGenomes([players[i].model for i in members], memSize), modelLayout(memSize))
+             for memSize, members in groups.items()}
+    memSizes = sorted(groups)
+    for memSize in memSizes:
+        members = np.array(groups[memSize])
+        genomes = sides[memSize]
+        for i in strategies:
+            theirs = countOutcomesBatch(_side(players[i], genomes[1], None), genomes, numRounds, len(members))
+            counts[i, members] = theirs
+            counts[members, i] = swapOutcomes(theirs)
+    for a, memSize1 in enumerate(memSizes):
+        for memSize2 in memSizes[a:]:
+            members1, members2 = np.array(groups[memSize1]), np.array(groups[memSize2])
+            if memSize1 == memSize2:
+                rows1, rows2 = np.triu_indices(len(members1))
+            else:
+                rows1, rows2 = np.divmod(np.arange(len(members1)*len(members2)), len(members2))
+            pairCounts = _pairOutcomes(sides[memSize1], rows1, sides[memSize2], rows2, numRounds)
+            counts[members2[rows2], members1[rows1]] = swapOutcomes(pairCounts)
+            counts[members1[rows1], members2[rows2]] = pairCounts
+    return counts